@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
+import base64
 import boto3
+import hashlib
 import json
 import os
 import subprocess
@@ -56,10 +58,14 @@ def upload_lambda_bundle(config):
         shutil.make_archive(local_filepath, 'zip', local_filepath)
         output_filename = local_filepath + '.zip'
 
+    # Record the hash in the same format as Lambda's CodeSha256, so deploys can tell whether the code has changed
+    with open(output_filename, 'rb') as f:
+        code_sha256 = base64.b64encode(hashlib.sha256(f.read()).digest()).decode('ascii')
+
     s3_key = 'lambdas/{}/{}/{}'.format(os.environ['PROJECT'], os.environ['LAMBCI_COMMIT'], config['s3_filename'])
     for region in config.get('regions', default_regions):
         print('    Uploading {} to s3://{}/{}'.format(output_filename, s3_buckets[region].name, s3_key))
-        s3_buckets[region].upload_file(output_filename, s3_key)
+        s3_buckets[region].upload_file(output_filename, s3_key, ExtraArgs={'Metadata': {'codesha256': code_sha256}})
 
 
 def read_config():
@@ -0,0 +1,256 @@
+#
+# Copyright 2017 Melon Software Ltd (UK), all rights reserved
+#
+# Consumes asynchronous API requests from an SQS queue.  Requests which are due are dispatched to the API's Lambda
+# function; requests with an `X-Execute-At` header in the future are put back on the queue until they are due, or
+# held in the schedule store if they are due too far in the future for that.  The queue also carries messages which
+# release provisioned concurrency raised to prewarm for a request, once the request has run.
+#
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import calendar
+import datetime
+import json
+import os
+import time
+
+from prewarm import prewarm, provisioned_hold_seconds, release_provisioned_concurrency
+from scheduler import get_schedule_store, schedule
+
+# SQS delivers at most this many records to each invocation, and accepts at most this many messages per batch send
+max_batch_size = 10
+
+# Requests due within this many seconds are executed straight away
+execute_threshold_seconds = 5
+
+# How to invoke the API's Lambda function for due requests: 'Event' hands the request to Lambda and returns straight
+# away, 'RequestResponse' waits for the function to finish so that its errors are seen here
+invocation_type = os.environ.get('INVOCATION_TYPE', 'Event')
+
+# Namespace of the CloudWatch metrics recorded for each invocation
+metrics_namespace = os.environ.get('METRICS_NAMESPACE', 'Biometrix/AsyncConsumer')
+
+_sqs_client = boto3.client('sqs')
+_lambda_client = boto3.client('lambda')
+
+
+class AsyncRequest:
+    """
+    One API request read from the queue
+    """
+    def __init__(self, record, now):
+        self.message_id = record['messageId']
+        self.body = json.loads(record['body'])
+        self.body.setdefault('requestContext', {})['eventSourceARN'] = record['eventSourceARN']
+        if self.body.get('headers') is None:
+            self.body['headers'] = {}
+        self.headers = self.body['headers']
+
+        if self.body.get('stageVariables') is not None:
+            self.version = self.body['stageVariables'].get('LambdaAlias', 'latest')
+        else:
+            self.version = self.body.get('path').split('/')[2]
+
+        if 'X-Execute-At' in self.headers:
+            execute_at = datetime.datetime.strptime(self.headers['X-Execute-At'], "%Y-%m-%dT%H:%M:%SZ")
+            self.execute_at = calendar.timegm(execute_at.timetuple())
+            self.delay_seconds = max(0, int((execute_at - now).total_seconds()))
+        else:
+            self.execute_at = None
+            self.delay_seconds = 0
+
+    @property
+    def is_due(self):
+        return self.delay_seconds <= execute_threshold_seconds
+
+
+def handler(event, _):
+    now = datetime.datetime.utcnow()
+    failures = []
+
+    requests = []
+    for record in event['Records']:
+        try:
+            body = json.loads(record['body'])
+            if 'ProvisionedConcurrencyRelease' in body:
+                if not handle_release(body['ProvisionedConcurrencyRelease']):
+                    failures.append(record['messageId'])
+                continue
+            requests.append(AsyncRequest(record, now))
+        except Exception as e:
+            # Retrying would not make it parse, so let it be deleted from the queue
+            print('Dropping unparseable message {}: {}'.format(record.get('messageId'), e))
+            print(record.get('body'))
+
+    for request in requests:
+        print(json.dumps(request.body))
+
+    deferred = [r for r in requests if not r.is_due]
+    store = get_schedule_store()
+    if store is not None and len(deferred):
+        deferred, failures = _schedule_far_future(store, deferred, failures)
+    if len(deferred):
+        print('Not executing {} requests yet'.format(len(deferred)))
+        for request in deferred:
+            try:
+                handle_prewarm(request)
+            except Exception as e:
+                print('Could not prewarm for message {}: {}'.format(request.message_id, e))
+        failures += requeue(deferred)
+
+    failures += dispatch([r for r in requests if r.is_due])
+
+    # Only the failed records are retried; the rest of the batch is deleted from the queue
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
+
+
+def _schedule_far_future(store, requests, failures):
+    """
+    Hand requests due too far in the future to wait on the queue to the scheduler
+    :return: (list[AsyncRequest], list[str]) The requests still to re-queue, and the updated failures
+    """
+    remaining = []
+    for request in requests:
+        try:
+            if not schedule(store, request.message_id, request.execute_at, request.body):
+                remaining.append(request)
+        except Exception as e:
+            print('Could not schedule message {}: {}'.format(request.message_id, e))
+            failures = failures + [request.message_id]
+    if len(remaining) < len(requests):
+        print('Scheduled {} requests'.format(len(requests) - len(remaining)))
+    return remaining, failures
+
+
+def handle_prewarm(request):
+    """
+    Prewarm the API a few minutes before a request with an `X-Prewarm` header is due, adjusting its delay so that it
+    is received again in time to do so
+    """
+    if 'X-Prewarm' not in request.headers:
+        return
+    if request.delay_seconds > 20 * 60:
+        # Do nothing, we'll re-process this at least 5 mins before, and deal with it then
+        pass
+    elif 10 * 60 < request.delay_seconds < 20 * 60:
+        # Retrigger 5 mins before so we can prewarm
+        request.delay_seconds -= 5 * 60
+    elif request.delay_seconds < 10 * 60:
+        result = prewarm(_lambda_client, os.environ['LAMBDA_ARN'], request.version, int(request.headers['X-Prewarm']))
+        del request.headers['X-Prewarm']
+        if result.provisioned_at is not None:
+            schedule_release(request.version, request.execute_at + provisioned_hold_seconds, result.provisioned_at)
+
+
+def schedule_release(version, release_at, provisioned_at):
+    """
+    Queue a message which releases provisioned concurrency raised for a request, once the request has run
+    """
+    message = {'Version': version, 'ReleaseAt': release_at, 'ProvisionedAt': provisioned_at}
+    _sqs_client.send_message(
+        QueueUrl=os.environ['SQS_QUEUE_URL'],
+        MessageBody=json.dumps({'ProvisionedConcurrencyRelease': message}),
+        DelaySeconds=max(0, min(int(release_at - time.time()), 15 * 60)),
+    )
+    print('Releasing provisioned concurrency of {} at {}'.format(version, release_at))
+
+
+def handle_release(message):
+    """
+    Release provisioned concurrency if it is due, otherwise put the message back on the queue until it is
+    :return: bool Whether the message was handled
+    """
+    try:
+        if message['ReleaseAt'] - time.time() > execute_threshold_seconds:
+            schedule_release(message['Version'], message['ReleaseAt'], message['ProvisionedAt'])
+        else:
+            release_provisioned_concurrency(_lambda_client, os.environ['LAMBDA_ARN'], message['Version'], message['ProvisionedAt'])
+        return True
+    except Exception as e:
+        print('Could not release provisioned concurrency of {}: {}'.format(message.get('Version'), e))
+        return False
+
+
+def requeue(requests):
+    """
+    Put requests which are not yet due back on the queue
+    :return: list[str] The message ids of the requests which could not be re-queued
+    """
+    failures = []
+    for i in range(0, len(requests), max_batch_size):
+        chunk = {r.message_id: r for r in requests[i:i + max_batch_size]}
+        try:
+            res = _sqs_client.send_message_batch(
+                QueueUrl=os.environ['SQS_QUEUE_URL'],
+                Entries=[{
+                    # Batch entry ids only allow alphanumerics, hyphens and underscores, which message ids satisfy
+                    'Id': message_id,
+                    'MessageBody': json.dumps(request.body),
+                    'DelaySeconds': min(request.delay_seconds, 15 * 60),
+                } for message_id, request in chunk.items()]
+            )
+        except Exception as e:
+            print('Could not re-queue messages: {}'.format(e))
+            failures += list(chunk)
+            continue
+        for failed in res.get('Failed', []):
+            print('Could not re-queue message {}: {}'.format(failed['Id'], failed.get('Message')))
+            failures.append(failed['Id'])
+    return failures
+
+
+def dispatch(requests):
+    """
+    Invoke the API's Lambda function for each request, concurrently.  With `Event` invocations each call only waits
+    for Lambda to accept the request, not for the API to run it.
+    :return: list[str] The message ids of the requests which failed
+    """
+    if len(requests) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        results = list(executor.map(_invoke, requests))
+    return [request.message_id for request, success in zip(requests, results) if not success]
+
+
+def _invoke(request):
+    start = time.time()
+    try:
+        res = _lambda_client.invoke(
+            FunctionName=os.environ['LAMBDA_ARN'],
+            Qualifier=request.version,
+            InvocationType=invocation_type,
+            Payload=json.dumps(request.body)
+        )
+    except Exception as e:
+        print('Could not invoke {} for message {}: {}'.format(request.version, request.message_id, e))
+        record_invoke_metrics(request.version, time.time() - start, failed=True)
+        return False
+    record_invoke_metrics(request.version, time.time() - start, failed=False)
+    if 'FunctionError' in res:
+        # The request reached the API, so as before it is not retried
+        print('Invocation of {} for message {} failed: {}'.format(request.version, request.message_id, res['Payload'].read()))
+    return True
+
+
+def record_invoke_metrics(version, latency, failed):
+    """
+    Record the latency and outcome of an invocation, in CloudWatch embedded metric format so that no API call is needed
+    """
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': [['FunctionName', 'InvocationType'], ['FunctionName', 'InvocationType', 'Version']],
+                'Metrics': [
+                    {'Name': 'InvokeLatency', 'Unit': 'Milliseconds'},
+                    {'Name': 'InvokeFailures', 'Unit': 'Count'},
+                ],
+            }],
+        },
+        'FunctionName': os.environ['LAMBDA_ARN'].split(':')[-1],
+        'InvocationType': invocation_type,
+        'Version': version,
+        'InvokeLatency': round(latency * 1000, 1),
+        'InvokeFailures': 1 if failed else 0,
+    }))
@@ -0,0 +1,171 @@
+#
+# Copyright 2017 Melon Software Ltd (UK), all rights reserved
+#
+# Warms up execution environments of an API's Lambda function ahead of a scheduled burst of requests.
+#
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import json
+import os
+import re
+import threading
+
+# The most execution environments a single prewarm may ask for, to bound its cost
+max_prewarm_count = int(os.environ.get('MAX_PREWARM_COUNT', 50))
+
+# 'invoke' to warm environments with concurrent requests, or 'provisioned' to use provisioned concurrency
+prewarm_mode = os.environ.get('PREWARM_MODE', 'invoke')
+
+# How long after a request is due to keep the provisioned concurrency raised for it
+provisioned_hold_seconds = int(os.environ.get('PROVISIONED_HOLD_SECONDS', 15 * 60))
+
+_init_duration_pattern = re.compile(r'Init Duration: [0-9.]+ ms')
+
+
+class PrewarmResult:
+    def __init__(self, requested):
+        self.requested = requested
+        self.succeeded = 0
+        self.cold_starts = 0
+        self.container_ids = set()
+        # When provisioned concurrency was raised, the `LastModified` of the config to release once the burst is over
+        self.provisioned_at = None
+
+    @property
+    def warm_concurrency(self):
+        """
+        The number of distinct execution environments known to be warm: counted exactly if the API reports its
+        container ids, otherwise assumed to be one per concurrent successful request
+        """
+        return len(self.container_ids) if self.container_ids else self.succeeded
+
+    def __str__(self):
+        return 'warmed {} of {} requested environments ({} successful requests, {} cold starts)'.format(
+            self.warm_concurrency, self.requested, self.succeeded, self.cold_starts
+        )
+
+
+def prewarm(lambda_client, function_arn, version, count):
+    """
+    Make `count` execution environments of a version of a Lambda function ready to serve requests
+    :param str version: The alias to warm, such as `2_0`
+    :return: PrewarmResult
+    """
+    if count > max_prewarm_count:
+        print('Limiting prewarm of {} from {} to {} environments'.format(version, count, max_prewarm_count))
+        count = max_prewarm_count
+    if count <= 0:
+        return PrewarmResult(0)
+
+    if prewarm_mode == 'provisioned':
+        return _provision(lambda_client, function_arn, version, count)
+
+    result = PrewarmResult(count)
+    lock = threading.Lock()
+    # Hold every request until all are ready to go, so that they overlap and each needs its own environment
+    barrier = threading.Barrier(count)
+
+    def warm(i):
+        try:
+            barrier.wait(timeout=10)
+        except threading.BrokenBarrierError:
+            pass
+        print(f'Triggering prewarm #{i}')
+        try:
+            res = lambda_client.invoke(
+                FunctionName=function_arn,
+                Qualifier=version,
+                LogType='Tail',
+                Payload=json.dumps(get_prewarm_payload(version)),
+            )
+        except Exception as e:
+            print('Prewarm #{} of {} failed: {}'.format(i, version, e))
+            return
+        if 'FunctionError' in res:
+            print('Prewarm #{} of {} failed: {}'.format(i, version, res['Payload'].read()))
+            return
+        container_id = _get_container_id(res['Payload'].read())
+        with lock:
+            result.succeeded += 1
+            if _init_duration_pattern.search(base64.b64decode(res.get('LogResult', '')).decode('utf-8', 'replace')):
+                result.cold_starts += 1
+            if container_id is not None:
+                result.container_ids.add(container_id)
+
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        list(executor.map(warm, range(count)))
+
+    print('Prewarm of {}: {}'.format(version, result))
+    return result
+
+
+def get_prewarm_payload(version):
+    return {
+        "path": '/misc/prewarm',
+        "httpMethod": 'POST',
+        "headers": {
+            "Accept": "*/*",
+            "Content-Type": "application/json",
+            "User-Agent": "Biometrix/Prewarmer",
+        },
+        "pathParameters": {"endpoint": 'misc/prewarm'},
+        "stageVariables": {"LambdaAlias": version},
+        "body": None,
+        "isBase64Encoded": False,
+        "requestContext": {"eventSourceARN": "sqs:prewarm"}
+    }
+
+
+def _get_container_id(payload):
+    """
+    The id of the execution environment which served a prewarm request, if the API reported it, either in an
+    `X-Container-Id` response header or a `container_id` field of the response body
+    """
+    try:
+        response = json.loads(payload)
+        container_id = (response.get('headers') or {}).get('X-Container-Id')
+        if container_id is None and response.get('body'):
+            container_id = json.loads(response['body']).get('container_id')
+        return container_id
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def _provision(lambda_client, function_arn, version, count):
+    """
+    Raise the provisioned concurrency of the alias to at least `count`.  The config is written even if it is already
+    high enough, so that its `LastModified` shows that this prewarm now owns its release.
+    """
+    result = PrewarmResult(count)
+    try:
+        current = lambda_client.get_provisioned_concurrency_config(FunctionName=function_arn, Qualifier=version)
+        count = max(count, current['RequestedProvisionedConcurrentExecutions'])
+    except lambda_client.exceptions.ProvisionedConcurrencyConfigNotFoundException:
+        pass
+    res = lambda_client.put_provisioned_concurrency_config(
+        FunctionName=function_arn,
+        Qualifier=version,
+        ProvisionedConcurrentExecutions=count,
+    )
+    result.succeeded = count
+    result.provisioned_at = res['LastModified']
+    print('Provisioned {} environments for {}'.format(count, version))
+    return result
+
+
+def release_provisioned_concurrency(lambda_client, function_arn, version, provisioned_at):
+    """
+    Remove the provisioned concurrency of the alias, unless a later prewarm has changed it since it was raised at
+    `provisioned_at`, in which case that prewarm will release it instead
+    :return: bool Whether it was removed
+    """
+    try:
+        current = lambda_client.get_provisioned_concurrency_config(FunctionName=function_arn, Qualifier=version)
+    except lambda_client.exceptions.ProvisionedConcurrencyConfigNotFoundException:
+        return False
+    if current['LastModified'] != provisioned_at:
+        print('Provisioned concurrency of {} has changed since {}, leaving it'.format(version, provisioned_at))
+        return False
+    lambda_client.delete_provisioned_concurrency_config(FunctionName=function_arn, Qualifier=version)
+    print('Released provisioned concurrency of {}'.format(version))
+    return True
@@ -0,0 +1,212 @@
+#
+# Copyright 2017 Melon Software Ltd (UK), all rights reserved
+#
+# Holds asynchronous API requests which are due too far in the future to wait on the SQS queue, and a sweeper which
+# moves them onto the queue once they are within SQS's maximum message delay.
+#
+import boto3
+import datetime
+import json
+import os
+import threading
+import time
+
+# The longest delay SQS allows on a message; requests due later than this are held in the schedule store
+max_queue_delay_seconds = 15 * 60
+
+# Requests with an `X-Prewarm` header are moved to the queue this long before they are due, so that the consumer
+# receives them in time to prewarm the API
+prewarm_lead_seconds = 5 * 60
+
+# Scheduled requests are partitioned by the time at which they should be swept, in buckets of this many seconds
+bucket_seconds = 5 * 60
+
+# How far back the first sweep looks, before there is a watermark recording how far earlier sweeps have got
+sweep_lookback_seconds = int(os.environ.get('SWEEP_LOOKBACK_SECONDS', 60 * 60))
+
+# DynamoDB table holding scheduled requests, with a hash key of `Bucket` and a range key of `Id`
+schedule_table = os.environ.get('SCHEDULE_TABLE')
+
+
+def get_sweep_at(execute_at, headers):
+    """
+    :param int execute_at: Epoch time at which the request should execute
+    :param dict headers: The request's headers
+    :return: int Epoch time at which the request should be moved onto the queue
+    """
+    return execute_at - (prewarm_lead_seconds if 'X-Prewarm' in headers else 0)
+
+
+def get_bucket(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp - timestamp % bucket_seconds).strftime('%Y-%m-%dT%H:%M')
+
+
+def get_buckets(start, end):
+    """
+    :return: list[str] The buckets covering the epoch times from `start` to `end`
+    """
+    return [get_bucket(t) for t in range(int(start - start % bucket_seconds), int(end) + 1, bucket_seconds)]
+
+
+class InMemoryScheduleStore:
+    """
+    Holds scheduled requests in memory, as a stand-in for the DynamoDB store when running locally
+    """
+    def __init__(self):
+        self._buckets = {}
+        self._watermark = None
+        self._lock = threading.Lock()
+
+    def put(self, request_id, sweep_at, body):
+        with self._lock:
+            self._buckets.setdefault(get_bucket(sweep_at), {})[_make_id(sweep_at, request_id)] = {'SweepAt': sweep_at, 'Body': body}
+
+    def get_due(self, start, end):
+        """
+        :return: list[(str, str, int, str)] The bucket, id, sweep time and body of every request to be swept between
+                 `start` and `end`, earliest first
+        """
+        with self._lock:
+            return sorted([
+                (bucket, item_id, item['SweepAt'], item['Body'])
+                for bucket in get_buckets(start, end)
+                for item_id, item in self._buckets.get(bucket, {}).items()
+                if start <= item['SweepAt'] <= end
+            ], key=lambda item: item[2])
+
+    def delete(self, bucket, item_id):
+        with self._lock:
+            self._buckets.get(bucket, {}).pop(item_id, None)
+
+    def get_watermark(self):
+        """
+        :return: int|None The epoch time before which every request has been swept
+        """
+        return self._watermark
+
+    def set_watermark(self, timestamp):
+        self._watermark = timestamp
+
+
+class DynamoDbScheduleStore:
+    """
+    Holds scheduled requests in a DynamoDB table, partitioned by time bucket so that each sweep reads only the few
+    partitions it needs
+    """
+    def __init__(self, table_name):
+        self.table = boto3.resource('dynamodb').Table(table_name)
+
+    def put(self, request_id, sweep_at, body):
+        self.table.put_item(Item={
+            'Bucket': get_bucket(sweep_at),
+            'Id': _make_id(sweep_at, request_id),
+            'SweepAt': sweep_at,
+            'Body': body,
+            # Removed by the sweeper; the TTL only clears up anything left behind
+            'ExpiresAt': sweep_at + 7 * 24 * 60 * 60,
+        })
+
+    def get_due(self, start, end):
+        from boto3.dynamodb.conditions import Key
+        items = []
+        for bucket in get_buckets(start, end):
+            kwargs = {'KeyConditionExpression': Key('Bucket').eq(bucket), 'ConsistentRead': True}
+            while True:
+                res = self.table.query(**kwargs)
+                items += [
+                    (bucket, item['Id'], int(item['SweepAt']), item['Body'])
+                    for item in res['Items']
+                    if start <= int(item['SweepAt']) <= end
+                ]
+                if 'LastEvaluatedKey' not in res:
+                    break
+                kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+        return sorted(items, key=lambda item: item[2])
+
+    def delete(self, bucket, item_id):
+        self.table.delete_item(Key={'Bucket': bucket, 'Id': item_id})
+
+    def get_watermark(self):
+        # Kept in its own partition, which no time bucket's name can clash with
+        item = self.table.get_item(Key={'Bucket': 'watermark', 'Id': 'sweep'}, ConsistentRead=True).get('Item')
+        return None if item is None else int(item['SweptTo'])
+
+    def set_watermark(self, timestamp):
+        self.table.put_item(Item={'Bucket': 'watermark', 'Id': 'sweep', 'SweptTo': timestamp})
+
+
+def _make_id(sweep_at, request_id):
+    # Sorts by time within a bucket, and is unique per request
+    return '{}#{}'.format(sweep_at, request_id)
+
+
+_schedule_store = None
+
+
+def get_schedule_store():
+    """
+    The store for scheduled requests, or None if none is configured and requests should wait on the queue instead
+    """
+    global _schedule_store
+    if _schedule_store is None and schedule_table:
+        _schedule_store = DynamoDbScheduleStore(schedule_table)
+    return _schedule_store
+
+
+def schedule(store, request_id, execute_at, body):
+    """
+    Hold a request until it is nearly due
+    :return: bool Whether the request was scheduled; if False it is close enough to wait on the queue instead
+    """
+    sweep_at = get_sweep_at(execute_at, body['headers'])
+    if sweep_at - time.time() <= max_queue_delay_seconds:
+        return False
+    store.put(request_id, sweep_at, json.dumps(body))
+    return True
+
+
+def sweep(store, sqs_client, queue_url, now=None):
+    """
+    Move every request which should be on the queue within the maximum message delay onto it, with a delay that
+    brings it to the consumer at its sweep time.  Every bucket since the watermark left by the last sweep is read, so
+    requests which were overdue because sweeps failed or did not run are not left for the TTL to remove.
+    :return: int The number of requests moved
+    """
+    now = int(now or time.time())
+    watermark = store.get_watermark()
+    if watermark is None:
+        watermark = now - sweep_lookback_seconds
+    due = store.get_due(watermark, now + max_queue_delay_seconds)
+    # Requests are only stored if they sweep after the maximum delay, so anything due up to now has been read.  Later
+    # ones are read again next time, in case they were stored while this sweep was reading.
+    swept_to = now
+    moved = 0
+    for i in range(0, len(due), 10):
+        chunk = {str(n): item for n, item in enumerate(due[i:i + 10])}
+        res = sqs_client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{
+                'Id': entry_id,
+                'MessageBody': body,
+                'DelaySeconds': max(0, min(sweep_at - now, max_queue_delay_seconds)),
+            } for entry_id, (_, _, sweep_at, body) in chunk.items()]
+        )
+        for failed in res.get('Failed', []):
+            # Left in the store for the next sweep
+            print('Could not enqueue scheduled request {}: {}'.format(chunk[failed['Id']][1], failed.get('Message')))
+            swept_to = min(swept_to, chunk[failed['Id']][2] - 1)
+        for successful in res.get('Successful', []):
+            bucket, item_id, _, _ = chunk[successful['Id']]
+            store.delete(bucket, item_id)
+            moved += 1
+    store.set_watermark(max(watermark, swept_to))
+    return moved
+
+
+def sweep_handler(event, _):
+    store = get_schedule_store()
+    if store is None:
+        print('No schedule table configured')
+        return
+    moved = sweep(store, boto3.client('sqs'), os.environ['SQS_QUEUE_URL'])
+    print('Moved {} scheduled requests onto the queue'.format(moved))
@@ -0,0 +1,296 @@
+#
+# Copyright 2017 Melon Software Ltd (UK), all rights reserved
+#
+# A lambda function that will copy EC2 tags to all related Volumes and Network Interfaces, and RDS tags to snapshots.
+# Run on a schedule it reconciles every resource in the region; run from a CloudTrail event it only handles the
+# resources the event affected.  Recorded events can be replayed locally with
+#     python synchronise_ec2_tags.py [--dry-run] event.json [event.json...]
+# Based on http://mlapida.com/thoughts/tagging-and-snapshotting-with-lambda
+# Copyright Mike Lapidakis, Stephen Poole
+#
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import json
+import os
+import sys
+
+# EC2 accepts many resource ids per create_tags call; stay well clear of the request size limit
+max_resources_per_call = 500
+
+# Concurrent calls when tagging RDS resources, which can only be tagged one at a time
+max_workers = 8
+
+# Report the tags which would be applied without applying them
+dry_run = os.environ.get('DRY_RUN', 'false') == 'true'
+
+
+def handler(event, __):
+    if event.get('detail-type') == 'AWS API Call via CloudTrail':
+        handle_event(event)
+        return
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(f) for f in [handle_vpc, handle_ec2, handle_rds]]
+    for future in futures:
+        # Re-raise any failure, now that every pass has had its chance to run
+        future.result()
+
+
+def handle_event(event):
+    """
+    Synchronise the tags of only the resources affected by a CloudTrail event
+    """
+    detail = event['detail']
+    event_name = detail.get('eventName')
+    print('{} event {}'.format(event_name, detail.get('eventID')))
+    if detail.get('errorCode'):
+        print('Ignoring failed call: {}'.format(detail['errorCode']))
+        return
+
+    if event_name == 'RunInstances':
+        handle_ec2(instance_ids=find_values(detail.get('responseElements'), 'instanceId'))
+    elif event_name == 'CreateSnapshot':
+        handle_ec2(snapshot_ids=find_values(detail.get('responseElements'), 'snapshotId'))
+    elif event_name == 'CreateNatGateway':
+        handle_vpc(nat_gateway_ids=find_values(detail.get('responseElements'), 'natGatewayId'))
+    elif event_name == 'CreateDBSnapshot':
+        handle_rds(db_instance_ids=find_values(detail.get('requestParameters'), 'dBInstanceIdentifier'))
+    elif event_name == 'CreateTags':
+        # Tags changed on a resource whose tags are copied elsewhere.  Our own changes come back through here too, but
+        # stop once the copies match.
+        resource_ids = find_values(detail.get('requestParameters'), 'resourceId')
+        instance_ids = [r for r in resource_ids if r.startswith('i-')]
+        volume_ids = [r for r in resource_ids if r.startswith('vol-')]
+        nat_gateway_ids = [r for r in resource_ids if r.startswith('nat-')]
+        if len(instance_ids) or len(volume_ids):
+            handle_ec2(instance_ids=instance_ids, volume_ids=volume_ids)
+        if len(nat_gateway_ids):
+            handle_vpc(nat_gateway_ids=nat_gateway_ids)
+    else:
+        print('Ignoring unexpected event')
+
+
+def find_values(obj, key):
+    """
+    Find every value of a key anywhere in a CloudTrail request or response, whose shapes vary between services
+    :return: list
+    """
+    values = []
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if k == key and not isinstance(v, (dict, list)):
+                values.append(v)
+            else:
+                values += find_values(v, key)
+    elif isinstance(obj, list):
+        for v in obj:
+            values += find_values(v, key)
+    return sorted(set(values))
+
+
+def handle_rds(db_instance_ids=None):
+    """
+    :param list[str] db_instance_ids: If given, only handle the snapshots of these instances
+    """
+    rds_client = boto3.client('rds', region_name=os.environ['AWS_REGION'])
+    kwargs = {}
+    if db_instance_ids is not None:
+        if len(db_instance_ids) == 0:
+            return
+        kwargs = {'Filters': [{'Name': 'db-instance-id', 'Values': db_instance_ids}]}
+    instances = paginate(rds_client, 'describe_db_instances', 'DBInstances', kwargs)
+    snapshots = {}
+    for snapshot in paginate(rds_client, 'describe_db_snapshots', 'DBSnapshots', kwargs):
+        snapshots.setdefault(snapshot['DBInstanceIdentifier'], []).append(snapshot)
+
+    def get_changes(instance):
+        print('RDS instance {}'.format(instance['DBInstanceIdentifier']))
+        tags = tag_cleanup(get_rds_tags(rds_client, instance['DBInstanceArn'], instance))
+        return [
+            (snapshot['DBSnapshotArn'], tags)
+            for snapshot in snapshots.get(instance['DBInstanceIdentifier'], [])
+            if not tags_match(get_rds_tags(rds_client, snapshot['DBSnapshotArn'], snapshot), tags)
+        ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        changes = [change for changes in executor.map(get_changes, instances) for change in changes]
+        for snapshot_arn, _ in changes:
+            print('\tSnapshot {}'.format(snapshot_arn))
+        if not dry_run:
+            list(executor.map(lambda change: rds_client.add_tags_to_resource(ResourceName=change[0], Tags=change[1]), changes))
+    print('Tagged {} RDS snapshots'.format(len(changes)))
+
+
+def get_rds_tags(rds_client, arn, description):
+    # Newer API versions include the tags in the description, saving a call per resource
+    if 'TagList' in description:
+        return description['TagList']
+    return rds_client.list_tags_for_resource(ResourceName=arn)['TagList']
+
+
+def handle_ec2(instance_ids=None, volume_ids=None, snapshot_ids=None):
+    """
+    With no arguments, handle every instance, volume and snapshot.  Otherwise handle only the given instances (with
+    their volumes, network interfaces and the volumes' snapshots), volumes (with their snapshots) and snapshots.
+    """
+    ec2_client = boto3.client('ec2', region_name=os.environ['AWS_REGION'])
+    if instance_ids is None and volume_ids is None and snapshot_ids is None:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            instances, volumes, network_interfaces, snapshots = executor.map(lambda args: paginate(ec2_client, *args), [
+                ('describe_instances', 'Reservations'),
+                ('describe_volumes', 'Volumes'),
+                ('describe_network_interfaces', 'NetworkInterfaces'),
+                ('describe_snapshots', 'Snapshots', {'OwnerIds': ['self']}),
+            ])
+    else:
+        # Filters rather than ids, so that resources which have since been deleted are ignored rather than an error
+        instances, network_interfaces, snapshots = [], [], []
+        volume_ids = set(volume_ids or [])
+        if instance_ids:
+            instances = paginate(ec2_client, 'describe_instances', 'Reservations', _filter('instance-id', instance_ids))
+            network_interfaces = paginate(ec2_client, 'describe_network_interfaces', 'NetworkInterfaces', _filter('attachment.instance-id', instance_ids))
+            volume_ids |= {m['Ebs']['VolumeId'] for r in instances for i in r['Instances'] for m in i.get('BlockDeviceMappings', []) if 'Ebs' in m}
+        if snapshot_ids:
+            snapshots = paginate(ec2_client, 'describe_snapshots', 'Snapshots', dict(_filter('snapshot-id', snapshot_ids), OwnerIds=['self']))
+            volume_ids |= {s['VolumeId'] for s in snapshots if 'VolumeId' in s}
+        elif volume_ids:
+            snapshots = paginate(ec2_client, 'describe_snapshots', 'Snapshots', dict(_filter('volume-id', sorted(volume_ids)), OwnerIds=['self']))
+        volumes = paginate(ec2_client, 'describe_volumes', 'Volumes', _filter('volume-id', sorted(volume_ids))) if volume_ids else []
+
+    instances = [instance for reservation in instances for instance in reservation['Instances']]
+    volumes = {volume['VolumeId']: volume for volume in volumes}
+    network_interfaces = {eni['NetworkInterfaceId']: eni for eni in network_interfaces}
+
+    changes = TagChanges()
+    for instance in instances:
+        print('EC2 Instance {}'.format(instance['InstanceId']))
+        for volume_id, device in [(m['Ebs']['VolumeId'], m['DeviceName']) for m in instance.get('BlockDeviceMappings', []) if 'Ebs' in m]:
+            if volume_id in volumes:
+                changes.add(volume_id, volumes[volume_id].get('Tags', []), tag_cleanup(instance.get('Tags', []), '{} (' + device + ')'))
+        for eni in instance.get('NetworkInterfaces', []):
+            if eni['NetworkInterfaceId'] in network_interfaces:
+                changes.add(
+                    eni['NetworkInterfaceId'],
+                    network_interfaces[eni['NetworkInterfaceId']].get('TagSet', []),
+                    tag_cleanup(instance.get('Tags', []), "{} (eth" + str(eni['Attachment']['DeviceIndex']) + ')')
+                )
+
+    for snapshot in snapshots:
+        volume = volumes.get(snapshot.get('VolumeId'))
+        if volume is not None:
+            # The volume's tags as they will be once the changes above are made
+            volume_tags = changes.get_tags(volume['VolumeId'], volume.get('Tags', []))
+            changes.add(snapshot['SnapshotId'], snapshot.get('Tags', []), tag_cleanup(volume_tags, '{} (' + volume['VolumeId'] + ')'))
+
+    changes.apply(ec2_client)
+
+
+def handle_vpc(nat_gateway_ids=None):
+    """
+    :param list[str] nat_gateway_ids: If given, only handle these NAT gateways
+    """
+    ec2_client = boto3.client('ec2', region_name=os.environ['AWS_REGION'])
+    kwargs = {}
+    if nat_gateway_ids is not None:
+        if len(nat_gateway_ids) == 0:
+            return
+        kwargs = {'Filter': [{'Name': 'nat-gateway-id', 'Values': nat_gateway_ids}]}
+    nat_gateways = paginate(ec2_client, 'describe_nat_gateways', 'NatGateways', kwargs)
+
+    allocation_ids = [a['AllocationId'] for n in nat_gateways for a in n['NatGatewayAddresses'] if 'AllocationId' in a]
+    addresses = {}
+    if len(allocation_ids):
+        addresses = {a['AllocationId']: a for a in ec2_client.describe_addresses(AllocationIds=allocation_ids)['Addresses']}
+    eni_ids = [a['NetworkInterfaceId'] for n in nat_gateways for a in n['NatGatewayAddresses'] if 'NetworkInterfaceId' in a]
+    network_interfaces = {}
+    if len(eni_ids):
+        network_interfaces = {
+            eni['NetworkInterfaceId']: eni
+            for eni in paginate(ec2_client, 'describe_network_interfaces', 'NetworkInterfaces', {'NetworkInterfaceIds': eni_ids})
+        }
+
+    changes = TagChanges()
+    for nat_gateway in nat_gateways:
+        print('NAT Gateway {}'.format(nat_gateway['NatGatewayId']))
+        tags = tag_cleanup(nat_gateway.get('Tags', []), '{}')
+        for gateway_address in nat_gateway['NatGatewayAddresses']:
+            if gateway_address.get('NetworkInterfaceId') in network_interfaces:
+                changes.add(gateway_address['NetworkInterfaceId'], network_interfaces[gateway_address['NetworkInterfaceId']].get('TagSet', []), tags)
+            if gateway_address.get('AllocationId') in addresses:
+                changes.add(gateway_address['AllocationId'], addresses[gateway_address['AllocationId']].get('Tags', []), tags)
+
+    changes.apply(ec2_client)
+
+
+class TagChanges:
+    """
+    The tags to apply to EC2 resources, grouped so that resources needing the same tags are tagged in one call
+    """
+    def __init__(self):
+        self._tags = {}
+
+    def add(self, resource_id, existing_tags, tags):
+        """
+        Tag a resource, unless it already has the tags
+        """
+        if not tags_match(existing_tags, tags):
+            self._tags[resource_id] = tags
+
+    def get_tags(self, resource_id, existing_tags):
+        """
+        :return: list[dict] The tags a resource will have once the changes are applied
+        """
+        merged = {t['Key']: t['Value'] for t in existing_tags}
+        merged.update({t['Key']: t['Value'] for t in self._tags.get(resource_id, [])})
+        return [{'Key': k, 'Value': v} for k, v in merged.items()]
+
+    def apply(self, ec2_client):
+        groups = {}
+        for resource_id, tags in self._tags.items():
+            groups.setdefault(tuple(sorted((t['Key'], t['Value']) for t in tags)), []).append(resource_id)
+
+        for tags, resource_ids in groups.items():
+            print('\t{} resources: {{{}}}'.format(len(resource_ids), ','.join('{}={}'.format(k, v) for k, v in tags)))
+            if dry_run:
+                continue
+            for i in range(0, len(resource_ids), max_resources_per_call):
+                ec2_client.create_tags(
+                    Resources=resource_ids[i:i + max_resources_per_call],
+                    Tags=[{'Key': k, 'Value': v} for k, v in tags]
+                )
+        print('Tagged {} EC2 resources in {} calls'.format(len(self._tags), len(groups)))
+
+
+def _filter(name, values):
+    return {'Filters': [{'Name': name, 'Values': list(values)}]}
+
+
+def paginate(client, operation, key, kwargs=None):
+    return [item for page in client.get_paginator(operation).paginate(**(kwargs or {})) for item in page[key]]
+
+
+def tags_match(existing_tags, tags):
+    """
+    Whether a resource already has all of the given tags
+    """
+    existing = {t['Key']: t['Value'] for t in existing_tags or []}
+    return all(existing.get(t['Key']) == t['Value'] for t in tags)
+
+
+def tag_cleanup(tags, name_format=None):
+    temp_tags = []
+    for t in tags or []:
+        if t['Key'] == 'Name' and name_format is not None:
+            temp_tags.append({'Key': 'Name', 'Value': name_format.format(t['Value'])})
+        elif t['Key'] in os.environ['TAGS_TO_COPY'].split(','):
+            temp_tags.append(t)
+    return temp_tags
+
+
+if __name__ == '__main__':
+    # Replay recorded events
+    if '--dry-run' in sys.argv:
+        dry_run = True
+    for filename in [a for a in sys.argv[1:] if a != '--dry-run']:
+        with open(filename, 'r') as f:
+            handler(json.load(f), None)
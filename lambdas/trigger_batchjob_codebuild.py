@@ -1,14 +1,14 @@
 #
 # Copyright 2017 Melon Software Ltd (UK), all rights reserved
 #
+from botocore.exceptions import ClientError
 from botocore.vendored import requests
-from functools import partial
 import boto3
 import json
 import logging
 import os
 import random
-import sys
+import threading
 import time
 import traceback
 
@@ -18,6 +18,33 @@ boto3.set_stream_logger('boto')
 
 aws_region = os.environ['AWS_DEFAULT_REGION']
 
+# How long to wait between checks on a running build, and the longest a build may take
+check_interval = int(os.environ.get('CHECK_INTERVAL', 30))
+max_build_seconds = int(os.environ.get('MAX_BUILD_SECONDS', 3300))
+
+# SQS queue which delivers each check back to this function once its delay has passed.  The queue must trigger this
+# function with a batch size of 1, and needs a visibility timeout of at least the function's timeout.  Without one,
+# each invocation waits out the check interval itself before re-invoking the function.
+check_queue_url = os.environ.get('CHECK_QUEUE_URL')
+
+# Errors worth retrying a call for, on top of the retries the AWS SDK has already made
+TRANSIENT_ERROR_CODES = [
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'ServiceUnavailable',
+    'InternalError',
+    'InternalFailure',
+]
+
+# DynamoDB table recording in-flight builds, so that concurrent requests for the same version share one build
+build_registry_table = os.environ.get('BUILD_REGISTRY_TABLE')
+
+# Where to record in-flight builds: 'dynamodb' (the default when a table is configured), or 'memory' to coalesce only
+# requests handled by the same container, for running locally
+build_registry_type = os.environ.get('BUILD_REGISTRY', 'dynamodb' if build_registry_table else None)
+
 
 class HandlerException(Exception):
     pass
@@ -27,6 +54,16 @@ class ResourceException(Exception):
     pass
 
 
+class ResourcePendingException(Exception):
+    """
+    Raised by a resource whose operation has started but not yet finished.  The handler schedules another check with
+    the given state, which the resource will receive as `event['ResourceState']` to pick up where it left off.
+    """
+    def __init__(self, state):
+        super().__init__('Resource operation in progress')
+        self.state = state
+
+
 class CloudFormationHandler:
     def __init__(self, event, context):
         self.event = event
@@ -34,11 +71,20 @@ class CloudFormationHandler:
         self.resource_type = event.get('ResourceType', None)
         self.action = event.get('RequestType')
         self.physical_resource_id = event.get('PhysicalResourceId', None)
+        self.responded = False
+        # Leave some of the invocation's time to respond to CloudFormation if we run out
+        self.retry_policy = RetryPolicy(
+            timeout=context.get_remaining_time_in_millis() / 1000 - 10,
+            on_deadline=lambda e: self._send_cloudformation_response(False, reason='Timed out: {}'.format(e))
+        )
 
     def _send_cloudformation_response(self, success, response_data=None, reason=None):
         """
-        Send a CloudFormation response
+        Send a CloudFormation response, unless one has already been sent
         """
+        if self.responded:
+            return
+        self.responded = True
         try:
             json_response_body = json.dumps({
                 'Status': 'SUCCESS' if success else 'FAILED',
@@ -49,7 +95,9 @@ class CloudFormationHandler:
                 'LogicalResourceId': self.event['LogicalResourceId'],
                 'Data': response_data or {}
             }, default=json_serial)
-            requests.put(
+            # No deadline here: this is the last thing we do
+            RetryPolicy(base_delay=1, max_delay=5, max_attempts=3).call(
+                requests.put,
                 self.event['ResponseURL'],
                 data=json_response_body,
                 headers={'content-type': '', 'content-length': str(len(json_response_body))}
@@ -57,6 +105,38 @@ class CloudFormationHandler:
         except Exception as e:
             print("send(..) failed executing requests.put(..): " + str(e))
 
+    def _schedule_check(self, state):
+        """
+        Have this function invoked again once the check interval has passed, with the same event plus the state of the
+        pending operation.  With a check queue the delay is spent on the queue, and this invocation returns straight
+        away.
+        """
+        event = dict(self.event, ResourceState=state)
+        print('Checking again in {} seconds with state {}'.format(check_interval, json.dumps(state, default=json_serial)))
+        policy = self.retry_policy.with_options(on_deadline=None)
+        if check_queue_url is not None:
+            policy.call(
+                boto3.client('sqs', region_name=aws_region).send_message,
+                QueueUrl=check_queue_url,
+                MessageBody=json.dumps(event, default=json_serial),
+                # The longest delay SQS allows
+                DelaySeconds=min(check_interval, 15 * 60),
+                exceptions=ClientError,
+                retry_if=is_transient_error,
+            )
+        else:
+            logger.warning('No CHECK_QUEUE_URL configured, waiting for the check interval in this invocation')
+            # Leave time to respond to CloudFormation if the re-invocation itself fails
+            time.sleep(max(0, min(check_interval, self.retry_policy.remaining())))
+            policy.call(
+                boto3.client('lambda', region_name=aws_region).invoke,
+                FunctionName=self.context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps(event, default=json_serial),
+                exceptions=ClientError,
+                retry_if=is_transient_error,
+            )
+
     def process(self):
         """
         Process a request from CloudFormation
@@ -64,7 +144,7 @@ class CloudFormationHandler:
         try:
             # Construct a Resource object
             if self.resource_type == 'Custom::CodeBuildEcrImage':
-                resource = CodeBuildEcrImage(self.event)
+                resource = CodeBuildEcrImage(self.event, self.retry_policy)
             elif self.action == 'Delete':
                 # Probably rolling back, allow that to happen
                 self._send_cloudformation_response(True, reason="Allowing rollback")
@@ -89,6 +169,13 @@ class CloudFormationHandler:
             print("physical_resource_id={}".format(self.physical_resource_id))
             self._send_cloudformation_response(True)
 
+        except ResourcePendingException as e:
+            # Don't respond to CloudFormation yet, check again in a new invocation
+            try:
+                self._schedule_check(e.state)
+            except Exception as schedule_error:
+                self._send_cloudformation_response(False, reason='Could not schedule a check on progress: ' + str(schedule_error))
+
         except (HandlerException, ResourceException) as e:
             self._send_cloudformation_response(False, reason=str(e))
 
@@ -97,7 +184,11 @@ class CloudFormationHandler:
 
 
 class CodeBuildEcrImage:
-    def __init__(self, event):
+    def __init__(self, event, retry_policy, build_registry=None):
+        self.state = event.get('ResourceState') or {}
+        self.retry_policy = retry_policy
+        self.request_id = event.get('RequestId')
+        self.build_registry = build_registry or get_build_registry()
         self.codebuild_client = boto3.client('codebuild', region_name=aws_region)
         self.ecr_client = boto3.client('ecr', region_name=aws_region)
 
@@ -112,36 +203,70 @@ class CodeBuildEcrImage:
 
     def create(self, properties):
         """
-        Check whether the image exists in the ECR repository, if not trigger a CodeBuild job and wait
-        for it to complete.
+        Check whether the image exists in the ECR repository, if not trigger a CodeBuild job.  While the job is running
+        the handler re-invokes itself to check on it, and the resource is created once the job has finished.
         """
         ecr_registry_name = os.environ['ECR_REGISTRY']
         ecr_repository_name = os.environ['ECR_REPOSITORY']
         ecr_image_tag = properties.get('EcrImageTag', 'latest')
 
+        if 'BuildId' in self.state:
+            # Re-invoked to check on a build we started, or attached to, earlier
+            build_id = self.state['BuildId']
+            try:
+                self._assert_codebuild_completed(build_id)
+            except self.CodebuildStillRunningException:
+                if time.time() - self.state['StartedAt'] > max_build_seconds:
+                    raise ResourceException('CodeBuild build {} not completed after {} seconds'.format(build_id, max_build_seconds))
+                raise ResourcePendingException(self.state)
+            except self.CodebuildFailedException as e:
+                # Let the next request for this version start a fresh build
+                self.build_registry.release(ecr_image_tag, build_id)
+                raise ResourceException('{} ({})'.format(e, build_id))
+
+            # The image can take a few moments to appear after the build finishes
+            ecr_image_digest = self._wait_for_image_to_exist(ecr_registry_name, ecr_repository_name, ecr_image_tag)
+
+        else:
+            if 'AwaitingBuildFor' in self.state and time.time() - self.state['StartedAt'] > max_build_seconds:
+                raise ResourceException('No build of version {} started after {} seconds'.format(ecr_image_tag, max_build_seconds))
+            try:
+                ecr_image_digest = self._assert_image_exists(ecr_registry_name, ecr_repository_name, ecr_image_tag)
+                print('Found existing image in ECR with digest {}'.format(ecr_image_digest))
+            except self.NoSuchImageException:
+                # Need to create it, or wait for whoever is already creating it; check on it again later
+                raise ResourcePendingException(self._start_or_attach_to_build(ecr_image_tag))
+
+        return "{}/{}@{}".format(ecr_registry_name, ecr_repository_name, ecr_image_digest)
+
+    def _start_or_attach_to_build(self, ecr_image_tag):
+        """
+        Start a CodeBuild job for a version, unless another request already has one in flight
+        :return: dict The state with which to check on the build
+        """
+        claim = self.build_registry.claim(ecr_image_tag, self.request_id, time.time() + max_build_seconds)
+        if 'BuildId' in claim:
+            print('Attaching to build {} started by request {}'.format(claim['BuildId'], claim['Owner']))
+            return {'BuildId': claim['BuildId'], 'StartedAt': float(claim['StartedAt'])}
+        if claim['Owner'] != self.request_id:
+            # Claimed, but the build has not been started yet
+            print('Waiting for request {} to start a build of version "{}"'.format(claim['Owner'], ecr_image_tag))
+            return {'AwaitingBuildFor': ecr_image_tag, 'StartedAt': self.state.get('StartedAt', time.time())}
+
+        print('Triggering CodeBuild for version "{}"'.format(ecr_image_tag))
         try:
-            ecr_image_digest = self._assert_image_exists(ecr_registry_name, ecr_repository_name, ecr_image_tag)
-            print('Found existing image in ECR with digest {}'.format(ecr_image_digest))
-        except self.NoSuchImageException as e:
-            # Need to create it
-            print('Triggering CodeBuild for version "{}"'.format(ecr_image_tag))
             res = self.codebuild_client.start_build(
                 projectName='preprocessing-batchjob',
                 sourceVersion=ecr_image_tag,
             )
-            build_id = res['build']['id']
-            print('Build {}'.format(build_id))
-
-            # Wait for the image to be created
-            self._wait_for_codebuild_completion(
-                build_id,
-                delay=5,
-                tries=100
-            )
-
-            ecr_image_digest = self._assert_image_exists(ecr_registry_name, ecr_repository_name, ecr_image_tag)
-
-        return "{}/{}@{}".format(ecr_registry_name, ecr_repository_name, ecr_image_digest)
+        except Exception:
+            self.build_registry.release(ecr_image_tag, None)
+            raise
+        build_id = res['build']['id']
+        print('Build {}'.format(build_id))
+        started_at = time.time()
+        self.build_registry.record_build(ecr_image_tag, self.request_id, build_id, started_at)
+        return {'BuildId': build_id, 'StartedAt': started_at}
 
     def update(self, physical_resource_id, old_properties, new_properties):
         """
@@ -156,39 +281,40 @@ class CodeBuildEcrImage:
         """
         pass
 
-    def _wait_for_image_to_exist(self, repository_name, image_tag, delay=10, tries=15) -> (bool, str):
+    def _wait_for_image_to_exist(self, registry_name, repository_name, image_tag) -> str:
         """
         Wait for an image with a given tag to exist in an ECR repository
         """
-        return retry_call(
+        return self.retry_policy.with_options(base_delay=2, max_delay=10, max_attempts=10).call(
             self._assert_image_exists,
-            [repository_name, image_tag],
-            exceptions=self.NoSuchImageException,
-            tries=tries,
-            delay=delay
-        )
-
-    def _wait_for_codebuild_completion(self, build_id, delay=10, tries=15) -> (bool, str):
-        """
-        Wait for a CodeBuild job to complete
-        """
-        return retry_call(
-            self._assert_codebuild_completed,
-            [build_id],
-            exceptions=self.CodebuildStillRunningException,
-            tries=tries,
-            delay=delay
+            registry_name,
+            repository_name,
+            image_tag,
+            exceptions=self.NoSuchImageException
         )
 
     def _assert_image_exists(self, registry_name, repository_name, image_tag) -> str:
         """
         Check whether an image with a given tag exists in an ECR repository, returning its digest
         """
+        try:
+            res = self.ecr_client.describe_images(
+                repositoryName=repository_name,
+                imageIds=[{'imageTag': image_tag}]
+            )
+            return res['imageDetails'][0]['imageDigest']
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ImageNotFoundException':
+                raise self.NoSuchImageException('No image tagged {} in {}'.format(image_tag, repository_name))
+            elif e.response['Error']['Code'] != 'AccessDeniedException':
+                raise
+            print('Cannot describe images, falling back to listing: {}'.format(e))
+
         images = self._get_all_images(registry_name, repository_name)
         if image_tag in images:
             return images[image_tag]
         else:
-            raise self.NoSuchImageException()
+            raise self.NoSuchImageException('No image tagged {} in {}'.format(image_tag, repository_name))
 
     def _assert_codebuild_completed(self, build_id) -> bool:
         """
@@ -203,21 +329,165 @@ class CodeBuildEcrImage:
             print('CodeBuild job complete')
             return True
 
-    def _get_all_images(self, registry_name, repository_name, next_token=None):
-        if next_token is None:
-            res = self.ecr_client.list_images(repositoryName=repository_name)
+    def _get_all_images(self, registry_name, repository_name):
+        images = {}
+        kwargs = {'repositoryName': repository_name, 'filter': {'tagStatus': 'TAGGED'}}
+        while True:
+            res = self.ecr_client.list_images(**kwargs)
+            images.update({image['imageTag']: image['imageDigest'] for image in res['imageIds'] if 'imageTag' in image})
+            if 'nextToken' not in res:
+                return images
+            kwargs['nextToken'] = res['nextToken']
+
+
+class InMemoryBuildRegistry:
+    """
+    Records in-flight builds in memory.  This only coalesces requests handled by the same container, so is mostly
+    useful as a stand-in for the DynamoDB registry when running locally.
+    """
+    def __init__(self):
+        self._claims = {}
+        self._lock = threading.Lock()
+
+    def claim(self, source_version, owner, expires_at):
+        """
+        Claim the right to build a version, unless someone else holds an unexpired claim on it
+        :return: dict The claim now in force, whose `Owner` is `owner` if the claim succeeded
+        """
+        with self._lock:
+            existing = self._claims.get(source_version)
+            if existing is None or existing['ExpiresAt'] < time.time():
+                self._claims[source_version] = {'SourceVersion': source_version, 'Owner': owner, 'ExpiresAt': expires_at}
+            return dict(self._claims[source_version])
+
+    def record_build(self, source_version, owner, build_id, started_at):
+        """
+        Record the build started under a claim, so that other requests can attach to it
+        """
+        with self._lock:
+            existing = self._claims.get(source_version)
+            if existing is not None and existing['Owner'] == owner:
+                existing.update(BuildId=build_id, StartedAt=started_at)
+
+    def release(self, source_version, build_id):
+        """
+        Drop the claim on a version if it is still for the given build (or for no build yet, if None)
+        """
+        with self._lock:
+            existing = self._claims.get(source_version)
+            if existing is not None and existing.get('BuildId') == build_id:
+                del self._claims[source_version]
+
+
+class UncoordinatedBuildRegistry:
+    """
+    Records nothing, so that every request starts its own build
+    """
+    def claim(self, source_version, owner, expires_at):
+        return {'SourceVersion': source_version, 'Owner': owner, 'ExpiresAt': expires_at}
+
+    def record_build(self, source_version, owner, build_id, started_at):
+        pass
+
+    def release(self, source_version, build_id):
+        pass
+
+
+class DynamoDbBuildRegistry:
+    """
+    Records in-flight builds in a DynamoDB table, with a hash key of `SourceVersion` and a TTL on `ExpiresAt`
+    """
+    def __init__(self, table_name):
+        self.table = boto3.resource('dynamodb', region_name=aws_region).Table(table_name)
+
+    def claim(self, source_version, owner, expires_at):
+        try:
+            self.table.put_item(
+                Item={'SourceVersion': source_version, 'Owner': owner, 'ExpiresAt': int(expires_at)},
+                ConditionExpression='attribute_not_exists(SourceVersion) OR ExpiresAt < :now',
+                ExpressionAttributeValues={':now': int(time.time())},
+            )
+            return {'SourceVersion': source_version, 'Owner': owner, 'ExpiresAt': int(expires_at)}
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        existing = self.table.get_item(Key={'SourceVersion': source_version}, ConsistentRead=True).get('Item')
+        if existing is None:
+            # Released in the meantime
+            return self.claim(source_version, owner, expires_at)
+        return existing
+
+    def record_build(self, source_version, owner, build_id, started_at):
+        try:
+            self.table.update_item(
+                Key={'SourceVersion': source_version},
+                UpdateExpression='SET BuildId = :build_id, StartedAt = :started_at',
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'Owner'},
+                ExpressionAttributeValues={':build_id': build_id, ':started_at': int(started_at), ':owner': owner},
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            print('Claim on version "{}" was lost before build {} was recorded'.format(source_version, build_id))
+
+    def release(self, source_version, build_id):
+        if build_id is None:
+            condition, values = 'attribute_not_exists(BuildId)', None
         else:
-            res = self.ecr_client.list_images(repositoryName=repository_name, nextToken=next_token)
-        images = {image['imageTag'] if 'imageTag' in image else 'none': image['imageDigest'] for image in res['imageIds']}
-        if 'nextToken' in res:
-            images.update(self._get_all_images(registry_name, repository_name, res['nextToken']))
-        return images
+            condition, values = 'BuildId = :build_id', {':build_id': build_id}
+        try:
+            self.table.delete_item(
+                Key={'SourceVersion': source_version},
+                ConditionExpression=condition,
+                **({'ExpressionAttributeValues': values} if values else {})
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+
+_build_registry = None
+
+
+def get_build_registry():
+    """
+    The registry of in-flight builds chosen by `BUILD_REGISTRY`.  Without one, concurrent requests for the same version
+    each start a build.
+    """
+    global _build_registry
+    if _build_registry is None:
+        if build_registry_type == 'dynamodb':
+            if not build_registry_table:
+                raise HandlerException('BUILD_REGISTRY is dynamodb but no BUILD_REGISTRY_TABLE is configured')
+            _build_registry = DynamoDbBuildRegistry(build_registry_table)
+        elif build_registry_type == 'memory':
+            _build_registry = InMemoryBuildRegistry()
+        elif build_registry_type is None:
+            logger.warning('No BUILD_REGISTRY_TABLE configured, concurrent builds of the same version will not be coalesced')
+            _build_registry = UncoordinatedBuildRegistry()
+        else:
+            raise HandlerException("Unknown BUILD_REGISTRY '{}'".format(build_registry_type))
+    return _build_registry
 
 
 def handler(event, context):
     logger.info(json.dumps(event, default=json_serial, indent=4))
-    cf_handler = CloudFormationHandler(event, context)
-    cf_handler.process()
+    if 'Records' in event:
+        # Scheduled checks on pending operations, delivered from the check queue
+        for record in event['Records']:
+            CloudFormationHandler(json.loads(record['body']), context).process()
+    else:
+        CloudFormationHandler(event, context).process()
+
+
+def is_transient_error(e):
+    """
+    :param ClientError e:
+    :return: bool
+    """
+    error_code = e.response.get('Error', {}).get('Code')
+    return error_code in TRANSIENT_ERROR_CODES or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
 
 
 def json_serial(obj):
@@ -231,32 +501,82 @@ def json_serial(obj):
     raise TypeError("Type not serializable")
 
 
-def retry_call(f, fargs=None, fkwargs=None, exceptions=Exception, tries=-1, delay=1,
-               max_delay=sys.maxsize, backoff=1, jitter=0):
+class RetryPolicy:
     """
-    Calls a function and re-executes it if it failed.
-    :param f: the function to execute
-    :param fargs: the positional arguments of the function to execute.
-    :param fkwargs: the named arguments of the function to execute.
-    :param exceptions: an exception or a tuple of exceptions to catch. default: Exception.
-    :param tries: the maximum number of attempts. default: -1 (infinite)
-    :param delay: initial delay between attempts. default: 1
-    :param max_delay: the maximum value of delay. default: None (no limit)
-    :param backoff: multiplier applied to delay between attempts. default: 1 (no backoff)
-    :param jitter: extra seconds added to delay between attempts. default: 0
-                   fixed if a number, random if a range tuple (min, max)
-    :returns: the result of the f function
+    Retries a call with exponentially growing, decorrelated-jitter delays, giving up after a number of attempts or
+    when a deadline would be passed.  Keep in step with scripts/components/retry.py.
     """
-    function_to_call = partial(f, *(fargs if fargs else list()), **(fkwargs if fkwargs else dict()))
-    while tries:
-        try:
-            return function_to_call()
-        except exceptions as e:
-            tries -= 1
-            if tries == 0:
-                raise
+    def __init__(self, *, base_delay=1, max_delay=30, max_attempts=None, timeout=None, deadline=None, on_deadline=None):
+        """
+        :param float base_delay: The minimum delay between attempts
+        :param float max_delay: The maximum delay between attempts
+        :param int max_attempts: The maximum number of attempts, or None for no limit
+        :param float timeout: Seconds from now after which to give up
+        :param float deadline: Absolute `time.time()` after which to give up; the earlier of this and `timeout` is used
+        :param callable on_deadline: Called with the last exception when giving up because of the deadline; if it
+                                     does not raise, the last exception is re-raised
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        if timeout is not None:
+            self.deadline = min(filter(None, [deadline, time.time() + timeout]))
+        self.on_deadline = on_deadline
+
+    def with_options(self, **kwargs):
+        """
+        A copy of this policy, with the same deadline and hook unless they are among the options changed
+        """
+        options = dict(
+            base_delay=self.base_delay,
+            max_delay=self.max_delay,
+            max_attempts=self.max_attempts,
+            deadline=self.deadline,
+            on_deadline=self.on_deadline,
+        )
+        options.update(kwargs)
+        return RetryPolicy(**options)
+
+    def remaining(self):
+        """
+        :return: float|None Seconds until the deadline
+        """
+        return None if self.deadline is None else self.deadline - time.time()
 
-            logger.warning('%s, retry #%s in %s seconds...', e, delay, tries)
+    def next_delay(self, previous_delay):
+        """
+        Decorrelated jitter: somewhere between the base delay and three times the previous delay
+        """
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous_delay * 3)))
 
-            time.sleep(delay)
-            delay = min(delay * backoff + (random.uniform(*jitter) if isinstance(jitter, tuple) else jitter), max_delay)
+    def call(self, f, *args, exceptions=Exception, retry_if=None, **kwargs):
+        """
+        Call a function, retrying it if it raises one of the given exceptions
+        :param callable f:
+        :param exceptions: An exception class or tuple of classes to retry on
+        :param callable retry_if: If given, only exceptions for which this returns True are retried
+        :return: The return value of f
+        """
+        attempt = 0
+        delay = self.base_delay
+        while True:
+            attempt += 1
+            try:
+                return f(*args, **kwargs)
+            except exceptions as e:
+                if retry_if is not None and not retry_if(e):
+                    raise
+                if self.max_attempts is not None and attempt >= self.max_attempts:
+                    raise
+
+                delay = self.next_delay(delay)
+                remaining = self.remaining()
+                if remaining is not None and remaining < delay:
+                    logger.warning('%s, no time left to retry', e)
+                    if self.on_deadline is not None:
+                        self.on_deadline(e)
+                    raise
+
+                logger.warning('%s, retry #%s in %.1f seconds...', e, attempt, delay)
+                time.sleep(delay)
@@ -0,0 +1,210 @@
+#! /usr/bin/env python3
+# Compare the DynamoDB reads made by the old (filtered query) and new (commit index) LambCI build lookups
+#
+# Runs against moto by default, or against DynamoDB Local with --endpoint-url.  moto does not model consumed capacity,
+# so read capacity is also estimated from the size of the items each request reads, using DynamoDB's rounding rules.
+
+import argparse
+import math
+import random
+from colorama import Fore
+from decimal import Decimal
+
+from components import repository as repository_module
+from components.repository import Repository
+from components.ui import cprint
+
+
+class MeteredTable:
+    """
+    Wraps a DynamoDB Table, counting the requests made through it and the read capacity they consume
+    """
+    def __init__(self, table):
+        self._table = table
+        self.requests = 0
+        self.reported_capacity = 0.0
+        self.estimated_capacity = 0.0
+
+    def query(self, **kwargs):
+        res = self._table.query(ReturnConsumedCapacity='TOTAL', **kwargs)
+        self._record(res)
+        # Items dropped by a FilterExpression are still read and billed, so measure what the key condition matched
+        unfiltered = {k: v for k, v in kwargs.items() if k != 'FilterExpression'}
+        matched = self._table.query(**unfiltered)['Items']
+        self.estimated_capacity += read_units(sum(item_size(i) for i in matched), kwargs.get('ConsistentRead', False))
+        return res
+
+    def get_item(self, **kwargs):
+        res = self._table.get_item(ReturnConsumedCapacity='TOTAL', **kwargs)
+        self._record(res)
+        self.estimated_capacity += read_units(item_size(res.get('Item', {})), kwargs.get('ConsistentRead', False))
+        return res
+
+    def _record(self, res):
+        self.requests += 1
+        self.reported_capacity += float(res.get('ConsumedCapacity', {}).get('CapacityUnits', 0))
+
+
+def read_units(size, consistent):
+    units = max(1, math.ceil(size / 4096))
+    return units if consistent else units / 2
+
+
+def item_size(item):
+    """
+    Approximate size of an item as DynamoDB bills it: attribute names plus values
+    """
+    size = 0
+    for name, value in item.items():
+        size += len(name.encode('utf-8'))
+        if isinstance(value, (int, float, Decimal)):
+            size += math.ceil(len(str(value).lstrip('-').replace('.', '')) / 2) + 1
+        else:
+            size += len(str(value).encode('utf-8'))
+    return size
+
+
+def create_table(dynamodb):
+    # The same schema as BuildsTable in cloudformation/infrastructure-lambci.yaml
+    return dynamodb.create_table(
+        TableName='infrastructure-lambci-builds',
+        AttributeDefinitions=[
+            {'AttributeName': 'project', 'AttributeType': 'S'},
+            {'AttributeName': 'buildNum', 'AttributeType': 'N'},
+            {'AttributeName': 'commit', 'AttributeType': 'S'},
+        ],
+        KeySchema=[
+            {'AttributeName': 'project', 'KeyType': 'HASH'},
+            {'AttributeName': 'buildNum', 'KeyType': 'RANGE'},
+        ],
+        LocalSecondaryIndexes=[{
+            'IndexName': 'commit',
+            'KeySchema': [
+                {'AttributeName': 'project', 'KeyType': 'HASH'},
+                {'AttributeName': 'commit', 'KeyType': 'RANGE'},
+            ],
+            'Projection': {'ProjectionType': 'KEYS_ONLY'},
+        }],
+        BillingMode='PAY_PER_REQUEST',
+    )
+
+
+def seed(table, project, count):
+    """
+    Fill the table with a build history, returning the commits in build order
+    """
+    commits = ['%040x' % random.getrandbits(160) for _ in range(count)]
+    with table.batch_writer() as batch:
+        for build_number, commit in enumerate(commits, start=1):
+            batch.put_item(Item={
+                'project': project,
+                'buildNum': build_number,
+                'commit': commit,
+                'status': 'success',
+                'trigger': 'push',
+                'requestId': '%032x' % random.getrandbits(128),
+                'checkoutBranch': 'master',
+                'cloneUrl': f'https://github.com/biometrixtech/{project}.git',
+                'logUrl': f'https://console.aws.amazon.com/cloudwatch/home?region=us-east-1#logEventViewer:group=/aws/lambda/lambci-build;stream={commit}',
+                'startedAt': 1546300800 + build_number * 600,
+                'endedAt': 1546300800 + build_number * 600 + 240,
+                'commitMessage': 'x' * args.message_size,
+            })
+    return commits
+
+
+def legacy_lookup(table, project, version, polls):
+    """
+    The lookup as it was: a query of the project's whole history filtered on commit (without pagination), then a
+    query for the build's status on every poll
+    """
+    from boto3.dynamodb.conditions import Key, Attr
+    builds = table.query(
+        KeyConditionExpression=Key('project').eq(project),
+        FilterExpression=Attr('commit').eq(version),
+        ScanIndexForward=False,
+    )['Items']
+    if len(builds) == 0:
+        return None
+    build_number = max(b['buildNum'] for b in builds)
+    for _ in range(polls):
+        kcx = Key('project').eq(project) & Key('buildNum').eq(build_number)
+        table.query(KeyConditionExpression=kcx)
+    return build_number
+
+
+def indexed_lookup(table, repository, version, polls):
+    """
+    The lookup as it is now, through Repository
+    """
+    repository_module._completed_builds.clear()
+    repository_module.get_lambci_builds_table = lambda: table
+    build_number = repository.get_build_number_for_version(version)
+    for _ in range(polls):
+        repository.get_build_status(build_number)
+    return build_number
+
+
+def main(dynamodb):
+    table = create_table(dynamodb)
+    repository = Repository.__new__(Repository)
+    repository.service = args.service
+    project = repository.lambci_project_name
+
+    cprint(f'Seeding {args.builds} builds of {project}', colour=Fore.CYAN)
+    commits = seed(table, project, args.builds)
+    # Deploys are usually of recent builds, but the old lookup's cost does not depend on which
+    version = commits[-args.age]
+
+    results = []
+    for name, lookup in [
+        ('filtered query', lambda t: legacy_lookup(t, project, version, args.polls)),
+        ('commit index', lambda t: indexed_lookup(t, repository, version, args.polls)),
+    ]:
+        metered = MeteredTable(table)
+        build_number = lookup(metered)
+        results.append((name, build_number, metered))
+
+    cprint(f'Looking up build of {version[:16]} (#{args.builds - args.age + 1}), then {args.polls} status checks', colour=Fore.CYAN)
+    cprint(f'{"":16} {"found":>8} {"requests":>9} {"est. RCU":>9} {"reported RCU":>13}')
+    for name, build_number, metered in results:
+        cprint(f'{name:16} {str(build_number):>8} {metered.requests:>9} {metered.estimated_capacity:>9.1f} {metered.reported_capacity:>13.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the read capacity used by the old and new LambCI build lookups')
+    parser.add_argument('--service',
+                        default='preprocessing',
+                        help='The service whose build history to simulate')
+    parser.add_argument('--builds',
+                        type=int,
+                        default=2000,
+                        help='The number of builds in the simulated history')
+    parser.add_argument('--age',
+                        type=int,
+                        default=1,
+                        help='How many builds ago the looked-up build was (1 is the latest)')
+    parser.add_argument('--polls',
+                        type=int,
+                        default=3,
+                        help='The number of status checks made after the lookup')
+    parser.add_argument('--message-size',
+                        dest='message_size',
+                        type=int,
+                        default=200,
+                        help='The length of the commit message stored with each build')
+    parser.add_argument('--endpoint-url',
+                        dest='endpoint_url',
+                        default=None,
+                        help='A DynamoDB Local endpoint to use instead of moto, eg http://localhost:8000')
+
+    args = parser.parse_args()
+
+    import boto3
+    if args.endpoint_url is not None:
+        main(boto3.resource('dynamodb', region_name='us-east-1', endpoint_url=args.endpoint_url,
+                            aws_access_key_id='local', aws_secret_access_key='local'))
+    else:
+        from moto import mock_aws
+        with mock_aws():
+            main(boto3.resource('dynamodb', region_name='us-east-1'))
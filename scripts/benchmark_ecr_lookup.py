@@ -0,0 +1,203 @@
+#! /usr/bin/env python3
+# Compare the ECR calls made by the old (list every image) and new (describe one tag) image lookups
+#
+# The lookups run against a real ECR client whose responses come from a botocore Stubber simulating a repository, so
+# no AWS account is needed.  The new lookups are CodeBuildEcrImage's own, from lambdas/trigger_batchjob_codebuild.py.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+from botocore.stub import Stubber
+from colorama import Fore
+
+from components.ui import cprint
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../lambdas'))
+# The lambda reads its region at import time
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+from trigger_batchjob_codebuild import CodeBuildEcrImage  # noqa: E402
+
+# The most image ids ListImages returns in one page when maxResults is not given
+list_page_size = 100
+
+# Only used to build the image's name, so any registry will do
+registry_name = '123456789012.dkr.ecr.us-east-1.amazonaws.com'
+
+
+class MeteredClient:
+    """
+    Wraps a stubbed ECR client, counting the calls made through it and the size of their responses
+    """
+    def __init__(self, client):
+        self._client = client
+        self.calls = {}
+        self.response_bytes = 0
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def call(**kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            res = method(**kwargs)
+            self.response_bytes += len(json.dumps({k: v for k, v in res.items() if k != 'ResponseMetadata'}, default=str))
+            return res
+        return call
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+def make_repository(count, untagged):
+    """
+    A simulated repository's images, as (tag, digest) pairs with a tag of None for untagged images, oldest first
+    """
+    images = []
+    for i in range(count):
+        tag = None if random.random() < untagged else f'{i:04x}{random.getrandbits(144):036x}'
+        images.append((tag, 'sha256:%064x' % random.getrandbits(256)))
+    return images
+
+
+def stub_list_images(stubber, repository_name, images, tagged_only):
+    """
+    Queue the ListImages pages that listing the repository will read
+    """
+    if tagged_only:
+        images = [image for image in images if image[0] is not None]
+    pages = [images[i:i + list_page_size] for i in range(0, len(images), list_page_size)] or [[]]
+    for n, page in enumerate(pages):
+        expected = {'repositoryName': repository_name}
+        if tagged_only:
+            expected['filter'] = {'tagStatus': 'TAGGED'}
+        if n > 0:
+            expected['nextToken'] = f'page-{n}'
+        response = {'imageIds': [
+            {'imageDigest': digest} if tag is None else {'imageTag': tag, 'imageDigest': digest}
+            for tag, digest in page
+        ]}
+        if n < len(pages) - 1:
+            response['nextToken'] = f'page-{n + 1}'
+        stubber.add_response('list_images', response, expected)
+
+
+def stub_describe_image(stubber, repository_name, image_tag, digest, denied=False):
+    expected = {'repositoryName': repository_name, 'imageIds': [{'imageTag': image_tag}]}
+    if denied:
+        stubber.add_client_error('describe_images', 'AccessDeniedException', expected_params=expected)
+    elif digest is None:
+        stubber.add_client_error('describe_images', 'ImageNotFoundException', expected_params=expected)
+    else:
+        stubber.add_response('describe_images', {'imageDetails': [{
+            'registryId': '123456789012',
+            'repositoryName': repository_name,
+            'imageDigest': digest,
+            'imageTags': [image_tag],
+            'imageSizeInBytes': 734003200,
+            'imagePushedAt': 1546300800,
+        }]}, expected)
+
+
+def legacy_lookup(ecr_client, repository_name, image_tag, next_token=None):
+    """
+    The lookup as it was: recursively list every image in the repository, then look for the tag
+    """
+    if next_token is None:
+        res = ecr_client.list_images(repositoryName=repository_name)
+    else:
+        res = ecr_client.list_images(repositoryName=repository_name, nextToken=next_token)
+    images = {image['imageTag'] if 'imageTag' in image else 'none': image['imageDigest'] for image in res['imageIds']}
+    if 'nextToken' in res:
+        images.update(legacy_lookup(ecr_client, repository_name, None, res['nextToken']))
+    return images if image_tag is None else images.get(image_tag)
+
+
+def get_resource(ecr_client):
+    """
+    A CodeBuildEcrImage using the given ECR client, without the other clients and build registry it would create
+    """
+    resource = CodeBuildEcrImage.__new__(CodeBuildEcrImage)
+    resource.ecr_client = ecr_client
+    return resource
+
+
+def current_lookup(ecr_client, repository_name, image_tag):
+    """
+    The lookup as it is now: CodeBuildEcrImage._assert_image_exists, which describes just the one tag, or lists tagged
+    images if the role may not call DescribeImages
+    """
+    resource = get_resource(ecr_client)
+    try:
+        # Quieten the fallback's message, printed on every check
+        with contextlib.redirect_stdout(io.StringIO()):
+            return resource._assert_image_exists(registry_name, repository_name, image_tag)
+    except CodeBuildEcrImage.NoSuchImageException:
+        return None
+
+
+def run(name, lookup, stub, images, image_tag, polls):
+    """
+    Look the tag up `polls` times, as _wait_for_image_to_exist does while a build is pushing, with the image missing
+    on every check but the last
+    """
+    import boto3
+    client = boto3.client('ecr', region_name='us-east-1', aws_access_key_id='stub', aws_secret_access_key='stub')
+    stubber = Stubber(client)
+    metered = MeteredClient(client)
+    digest = dict(images).get(image_tag)
+    with stubber:
+        for poll in range(polls):
+            stub(stubber, images if poll == polls - 1 else [i for i in images if i[0] != image_tag], digest if poll == polls - 1 else None)
+            found = lookup(metered, args.repository, image_tag)
+        stubber.assert_no_pending_responses()
+    return name, found == digest, metered
+
+
+def main():
+    images = make_repository(args.images, args.untagged)
+    image_tag = next(tag for tag, _ in reversed(images) if tag is not None)
+    repository_name = args.repository
+
+    results = [
+        run('list all', legacy_lookup,
+            lambda s, imgs, _: stub_list_images(s, repository_name, imgs, tagged_only=False),
+            images, image_tag, args.polls),
+        run('describe tag', current_lookup,
+            lambda s, _, digest: stub_describe_image(s, repository_name, image_tag, digest),
+            images, image_tag, args.polls),
+        run('list tagged', current_lookup,
+            lambda s, imgs, _: (stub_describe_image(s, repository_name, image_tag, None, denied=True),
+                                stub_list_images(s, repository_name, imgs, tagged_only=True)),
+            images, image_tag, args.polls),
+    ]
+
+    cprint(f'Looking up the latest tag in a repository of {args.images} images, {args.polls} times', colour=Fore.CYAN)
+    cprint(f'{"":14} {"found":>6} {"calls":>7} {"calls/check":>12} {"response KiB":>13}')
+    for name, found, metered in results:
+        cprint(f'{name:14} {str(found):>6} {metered.total_calls:>7} {metered.total_calls / args.polls:>12.1f} {metered.response_bytes / 1024:>13.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the ECR calls made by the old and new image lookups')
+    parser.add_argument('--images',
+                        type=int,
+                        default=1500,
+                        help='The number of images in the simulated repository')
+    parser.add_argument('--untagged',
+                        type=float,
+                        default=0.3,
+                        help='The fraction of images which are untagged')
+    parser.add_argument('--polls',
+                        type=int,
+                        default=5,
+                        help='The number of checks made while waiting for the image to be pushed')
+    parser.add_argument('--repository',
+                        default='biometrix/preprocessing',
+                        help='The name of the simulated repository')
+
+    args = parser.parse_args()
+    main()
@@ -1,8 +1,17 @@
 from colorama import Fore
-import boto3
 from botocore.exceptions import ClientError
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
 
+from components import aws
+from components.concurrency import map_concurrently
+from components.exceptions import ApplicationException
 from components.lambda_function import LambdaFunction
+from components.stage_quota import StageQuotaManager
 from components.ui import cprint
 
 
@@ -13,54 +22,135 @@ class ApiGateway:
         self._name = name
         self._lambda_function = lambda_function
 
-        self._apigateway_client = boto3.client('apigateway')
+        self._apigateway_client = aws.get_client('apigateway')
+        self._stage_quota = StageQuotaManager(self)
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def lambda_function(self) -> LambdaFunction:
+        return self._lambda_function
+
+    @property
+    def stage_quota(self) -> StageQuotaManager:
+        return self._stage_quota
+
     @property
     def id(self):
         if self._id is None:
-            for api in self._get_all_rest_apis():
-                if api['name'] == self._name:
-                    self._id = api['id']
-                    break
-            else:
-                raise Exception(f'API Gateway {self.name} was not found')
+            ids = get_rest_api_index(self._apigateway_client).get(self._name, [])
+            if len(ids) == 0:
+                raise ApplicationException(f'API Gateway {self.name} was not found')
+            elif len(ids) > 1:
+                raise ApplicationException(f'Multiple API Gateways are named {self.name}: {", ".join(ids)}')
+            self._id = ids[0]
         return self._id
 
-    def _get_all_rest_apis(self):
-        all_apis = self._apigateway_client.get_rest_apis()
-        # TODO paging
-        return all_apis['items']
+    def get_stages(self):
+        """
+        The `LambdaAlias` stage variable of every stage, or None for stages without one
+        :return: dict[str, str|None]
+        """
+        stages = self._apigateway_client.get_stages(restApiId=self.id)['item']
+        return {stage['stageName']: stage.get('variables', {}).get('LambdaAlias') for stage in stages}
+
+    def get_stage_lambda_aliases(self):
+        """
+        The `LambdaAlias` stage variable of each stage which has one
+        :return: dict[str, str]
+        """
+        return {stage_name: alias for stage_name, alias in self.get_stages().items() if alias is not None}
 
     def get_latest_deployment_id(self):
-        all_deployments = self._apigateway_client.get_deployments(restApiId=self.id)['items']
-        deployment_id = sorted(all_deployments, key=lambda x: x['createdDate'])[-1]['id']
-        return deployment_id
+        """
+        Get a deployment of the current API definition, creating one only if the definition has changed since the
+        latest deployment.  The result is memoized per API for the rest of the run.
+        :return: str
+        """
+        with _deployment_ids_lock:
+            if self.id not in _deployment_ids:
+                _deployment_ids[self.id] = self._get_current_deployment_id()
+            return _deployment_ids[self.id]
+
+    def _get_current_deployment_id(self):
+        deployments, fingerprint = aws.gather(self._get_all_deployments, self._get_definition_fingerprint)
+        fingerprint = f'definition:{fingerprint}'
+
+        if len(deployments) > 0:
+            latest_deployment = max(deployments, key=lambda x: x['createdDate'])
+            description = latest_deployment.get('description', '')
+            if fingerprint in description:
+                return latest_deployment['id']
+            elif 'definition:' not in description:
+                # Not deployed by us (eg by CloudFormation along with the definition), so assume it is current and
+                # record that so that later changes to the definition can be detected
+                self._apigateway_client.update_deployment(
+                    restApiId=self.id,
+                    deploymentId=latest_deployment['id'],
+                    patchOperations=[{'op': 'replace', 'path': '/description', 'value': f'{description} {fingerprint}'.strip()}],
+                )
+                return latest_deployment['id']
+
+        cprint(f'API definition for {self.name} has changed, creating a new deployment', colour=Fore.CYAN)
+        return self._apigateway_client.create_deployment(restApiId=self.id, description=fingerprint)['id']
+
+    def _get_all_deployments(self):
+        deployments = []
+        for page in self._apigateway_client.get_paginator('get_deployments').paginate(restApiId=self.id, PaginationConfig={'PageSize': 500}):
+            deployments += page['items']
+        return deployments
+
+    def _get_definition_fingerprint(self):
+        """
+        A hash of the API's resources, methods and integrations
+        :return: str
+        """
+        resources = []
+        for page in self._apigateway_client.get_paginator('get_resources').paginate(restApiId=self.id, embed=['methods'], PaginationConfig={'PageSize': 500}):
+            resources += page['items']
+        definition = json.dumps(sorted(resources, key=lambda r: r['path']), sort_keys=True, default=str)
+        return hashlib.sha256(definition.encode('utf-8')).hexdigest()[:16]
 
     def create_stage(self, semantic_version):
+        self.create_stages([semantic_version])
+
+    def create_stages(self, semantic_versions, max_workers=4):
+        """
+        Create stages for several versions against the current deployment, concurrently
+        :param list[VersionInfo|str] semantic_versions:
+        :param int max_workers: The maximum number of stages to create at once
+        """
         deployment_id = self.get_latest_deployment_id()
-        stage_name = self.semantic_version_to_stage_name(semantic_version)
-        cprint(f'Creating API Gateway stage {self.id}/{deployment_id}/{stage_name} for {self.name}', colour=Fore.CYAN)
-        try:
-            self._apigateway_client.create_stage(
-                restApiId=self.id,
-                deploymentId=deployment_id,
-                stageName=stage_name,
-                variables={'LambdaAlias': LambdaFunction.semantic_version_to_alias_name(semantic_version)},
-                tracingEnabled=True,
-            )
-        except ClientError as e:
-            if 'ConflictException' in str(e):
-                cprint(f'API Gateway stage {self.id}/{stage_name} already exists', colour=Fore.YELLOW)
-            elif 'LimitExceededException' in str(e):
-                cprint(f'Maximum number of API Gateway stages reached for API {self.id}.  Delete some old stages using delete_apigateway_stage.py', colour=Fore.RED)
-            else:
-                raise
+        self._stage_quota.make_room([self.semantic_version_to_stage_name(v) for v in semantic_versions])
+
+        def create(semantic_version):
+            stage_name = self.semantic_version_to_stage_name(semantic_version)
+            cprint(f'Creating API Gateway stage {self.id}/{deployment_id}/{stage_name} for {self.name}', colour=Fore.CYAN)
+            for attempt in range(2):
+                try:
+                    self._apigateway_client.create_stage(
+                        restApiId=self.id,
+                        deploymentId=deployment_id,
+                        stageName=stage_name,
+                        variables={'LambdaAlias': LambdaFunction.semantic_version_to_alias_name(semantic_version)},
+                        tracingEnabled=True,
+                    )
+                    break
+                except ClientError as e:
+                    if 'ConflictException' in str(e):
+                        cprint(f'API Gateway stage {self.id}/{stage_name} already exists', colour=Fore.YELLOW)
+                        break
+                    elif 'LimitExceededException' in str(e) and attempt == 0:
+                        # Something else created stages since we made room; prune again and retry
+                        self._stage_quota.make_room([stage_name])
+                    else:
+                        raise
 
-        self._lambda_function.add_apigateway_permission(semantic_version, self)
+            self._lambda_function.add_apigateway_permission(semantic_version, self)
+
+        map_concurrently(create, semantic_versions, max_workers=max_workers, description=f'Creating API Gateway stages for {self.name}')
 
     def delete_stage(self, semantic_version):
         stage_name = self.semantic_version_to_stage_name(semantic_version)
@@ -81,3 +171,57 @@ class ApiGateway:
     @staticmethod
     def semantic_version_to_stage_name(semantic_version):
         return str(semantic_version).replace('.', '_').rstrip('_')
+
+
+# Deployment ids to create new stages from, by REST API id
+_deployment_ids = {}
+_deployment_ids_lock = threading.Lock()
+
+# REST API name -> ids indexes, by region
+_rest_api_indexes = {}
+_rest_api_indexes_lock = threading.Lock()
+
+# How long to reuse a REST API index persisted to disk by a previous run; 0 disables persistence
+rest_api_cache_ttl = int(os.environ.get('APIGATEWAY_CACHE_TTL', 0))
+
+
+def get_rest_api_index(apigateway_client):
+    """
+    Get an index of the names of all the REST APIs in a region to their ids.  This is built once per region per run,
+    and optionally shared between runs through a cache file.
+
+    :param apigateway_client:
+    :return: dict[str, list[str]]
+    """
+    region = apigateway_client.meta.region_name
+    with _rest_api_indexes_lock:
+        if region not in _rest_api_indexes:
+            cache_path = os.path.join(tempfile.gettempdir(), f'biometrix-rest-apis-{region}.json')
+            index = _load_rest_api_index(cache_path) if rest_api_cache_ttl > 0 else None
+            if index is None:
+                index = {}
+                for page in apigateway_client.get_paginator('get_rest_apis').paginate(PaginationConfig={'PageSize': 500}):
+                    for api in page['items']:
+                        index.setdefault(api['name'], []).append(api['id'])
+                if rest_api_cache_ttl > 0:
+                    _save_rest_api_index(cache_path, index)
+            _rest_api_indexes[region] = index
+        return _rest_api_indexes[region]
+
+
+def _load_rest_api_index(cache_path):
+    try:
+        if time.time() - os.stat(cache_path).st_mtime > rest_api_cache_ttl:
+            return None
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_rest_api_index(cache_path, index):
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump(index, f)
+    except OSError:
+        pass
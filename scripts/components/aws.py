@@ -0,0 +1,83 @@
+# Shared AWS clients and resources, so that every component in a run reuses the same connection pools and retry
+# configuration.  boto3 is only imported, and clients only created, when first needed.
+import threading
+
+# Settings for every client; the pool is sized for the concurrent operations in components.concurrency
+max_pool_connections = 32
+connect_timeout = 5
+read_timeout = 60
+# Adaptive mode is the only retry layer for throttling and transient errors: callers do not wrap AWS calls in retries
+max_attempts = 10
+
+# Worker threads available to submit()
+max_workers = 16
+
+_clients = {}
+_resources = {}
+_lock = threading.Lock()
+_executor = None
+
+
+def get_config():
+    """
+    :return: botocore.config.Config
+    """
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=max_pool_connections,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        retries={'max_attempts': max_attempts, 'mode': 'adaptive'},
+    )
+
+
+def get_client(service_name, region_name=None):
+    """
+    Get the shared client for a service, creating it on first use from the default boto3 session
+    :param str service_name:
+    :param str region_name: Defaults to the session's region
+    """
+    key = (service_name, region_name)
+    with _lock:
+        # Creating clients from a session is not thread-safe, so always hold the lock
+        if key not in _clients:
+            import boto3
+            _clients[key] = boto3.client(service_name, region_name=region_name, config=get_config())
+        return _clients[key]
+
+
+def get_resource(service_name, region_name=None):
+    """
+    Get the shared resource for a service, creating it on first use from the default boto3 session
+    :param str service_name:
+    :param str region_name: Defaults to the session's region
+    """
+    key = (service_name, region_name)
+    with _lock:
+        if key not in _resources:
+            import boto3
+            _resources[key] = boto3.resource(service_name, region_name=region_name, config=get_config())
+        return _resources[key]
+
+
+def submit(f, *args, **kwargs):
+    """
+    Start an AWS call (or any other function) in the background on the shared thread pool
+    :return: concurrent.futures.Future
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='aws')
+    return _executor.submit(f, *args, **kwargs)
+
+
+def gather(*calls):
+    """
+    Run several independent calls concurrently and wait for all of them
+    :param callable calls: Functions taking no arguments
+    :return: list The results of the calls, in order
+    """
+    futures = [submit(call) for call in calls]
+    return [future.result() for future in futures]
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from components.exceptions import ApplicationException
+
+# Throttled AWS calls are retried by the shared clients' adaptive retry mode (see components.aws), which backs off
+# and rate-limits every request; nothing here retries them again.
+
+
+def map_concurrently(f, items, max_workers=8, description='operation'):
+    """
+    Apply a function to every item using a bounded pool of threads.  Every item is attempted even if some fail,
+    and the failures are then raised together.
+
+    :param callable f: The function to apply to each item
+    :param list items:
+    :param int max_workers: The maximum number of concurrent calls
+    :param str description: Description of the operation, for error messages
+    :return: list The results of f for each item, in order
+    """
+    items = list(items)
+    if len(items) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [executor.submit(f, item) for item in items]
+
+    results, errors = [], []
+    for item, future in zip(items, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            errors.append((item, e))
+
+    if errors:
+        raise ConcurrentOperationException(description, errors)
+    return results
+
+
+class ConcurrentOperationException(ApplicationException):
+    def __init__(self, description, errors):
+        """
+        :param str description:
+        :param list[(object, Exception)] errors: Pairs of item and the exception raised for it
+        """
+        self.errors = errors
+        super().__init__(f'{description} failed for {len(errors)} item(s):\n' + '\n'.join(f'  {item}: {e}' for item, e in errors))
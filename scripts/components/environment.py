@@ -1,10 +1,10 @@
-import boto3
 from semver import VersionInfo
 import sys
 import datetime
 import time
 from colorama import Fore
 
+from components import aws
 from components.ui import cprint, Spinner
 from components.repository import Repository
 from components.service import Service
@@ -18,6 +18,7 @@ class Environment(object):
         self._config = None
         self._stack_template_url = None
         self._stack = None
+        self._services = {}
 
         self._repository = Repository('infrastructure')
 
@@ -34,7 +35,7 @@ class Environment(object):
     @property
     def stack(self):
         if self._stack is None:
-            self._stack = boto3.resource('cloudformation', region_name=self.region).Stack(self._get_stack_name())
+            self._stack = aws.get_resource('cloudformation', self.region).Stack(self._get_stack_name())
         return self._stack
 
     def update_environment_version(self, version):
@@ -136,37 +137,52 @@ class Environment(object):
     def _get_service(self, service):
         if service not in ['hardware', 'plans', 'preprocessing', 'statsapi', 'time', 'users']:
             raise ValueError('Unrecognised service')
-        return Service(self, service)
+        # Services cache what they learn about their AWS resources, so keep them for the whole run
+        if service not in self._services:
+            self._services[service] = Service(self, service)
+        return self._services[service]
 
     def get_service_repository(self, service):
         return self._get_service(service).repository
 
     def update_lambda_functions(self, service, ref, tag=None):
         service = self._get_service(service)
-        service.update_lambda_functions(ref, tag is not None)
-        if tag is not None:
-            service.create_lambda_aliases(tag)
+        service.update_lambda_functions(ref, tag is not None, alias_tag=tag)
 
-    def update_sliding_lambda_aliases(self, service, semantic_version: VersionInfo):
+    def update_sliding_lambda_aliases(self, service, semantic_version: VersionInfo, semver_index=None):
+        """
+        Point the partially-pinned `major.minor` and `major_` aliases at a new version
+        :param str service:
+        :param VersionInfo semantic_version:
+        :param SemverIndex semver_index: If given, aliases are not slid back when a later version already exists
+        """
         service = self._get_service(service)
+        slide_minor = semver_index is None or semver_index.later_in_minor(semantic_version) is None
+        slide_major = semver_index is None or semver_index.later_in_major(semantic_version) is None
         if semantic_version.patch != 0:
             # New patch version --> slide both major and minor
-            service.update_lambda_aliases(f'{semantic_version.major}.{semantic_version.minor}', semantic_version)
-            service.update_lambda_aliases(f'{semantic_version.major}_', semantic_version)
+            if slide_minor:
+                service.update_lambda_aliases(f'{semantic_version.major}.{semantic_version.minor}', semantic_version)
+            if slide_major:
+                service.update_lambda_aliases(f'{semantic_version.major}_', semantic_version)
         elif semantic_version.patch == 0 and semantic_version.minor != 0:
             # New minor version --> slide major, new minor
             service.create_lambda_aliases(f'{semantic_version.major}.{semantic_version.minor}', semantic_version)
             service.create_apigateway_stages(f'{semantic_version.major}.{semantic_version.minor}')
-            service.update_lambda_aliases(f'{semantic_version.major}_', semantic_version)
+            if slide_major:
+                service.update_lambda_aliases(f'{semantic_version.major}_', semantic_version)
         else:
             # New major version
             service.create_lambda_aliases(f'{semantic_version.major}.{semantic_version.minor}', semantic_version)
-            service.create_apigateway_stages(f'{semantic_version.major}.{semantic_version.minor}')
             service.create_lambda_aliases(f'{semantic_version.major}_', semantic_version)
-            service.create_apigateway_stages(f'{semantic_version.major}_')
+            service.create_apigateway_stages(f'{semantic_version.major}.{semantic_version.minor}', f'{semantic_version.major}_')
 
     def create_apigateway_stages(self, service, tag):
-        self._get_service(service).create_apigateway_stages(tag=tag)
+        self._get_service(service).create_apigateway_stages(tag)
+
+    def print_policy_headroom_report(self, service):
+        for function_name, qualifier, size, limit in self._get_service(service).get_policy_headroom_report():
+            cprint(f'Resource policy for {function_name}:{qualifier} is {size} of {limit} bytes', colour=Fore.YELLOW if size > limit * 0.8 else Fore.CYAN)
 
     def _get_stack_name(self):
         return f'infrastructure-{self.name}'
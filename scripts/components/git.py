@@ -0,0 +1,97 @@
+import subprocess
+
+
+class Git(object):
+    """
+    Access to a local git repository which reads the whole ref table in one process and caches it for the rest of
+    the run, and resolves arbitrary revisions in batches
+    """
+    _instances = {}
+
+    def __init__(self, git_dir):
+        self._git_dir = git_dir
+        self._refs = None
+
+    @classmethod
+    def for_directory(cls, git_dir):
+        """
+        Get the shared Git object for a directory, so that every component in a run uses the same ref cache
+        :param str git_dir:
+        :return: Git
+        """
+        if git_dir not in cls._instances:
+            cls._instances[git_dir] = cls(git_dir)
+        return cls._instances[git_dir]
+
+    @property
+    def git_dir(self):
+        return self._git_dir
+
+    @property
+    def refs(self):
+        """
+        All the refs in the repository, mapped to the commit hash they point to (annotated tags are peeled)
+        :return: dict[str, str]
+        """
+        if self._refs is None:
+            output = self.execute('for-each-ref', '--format=%(objectname) %(*objectname) %(refname)')
+            self._refs = {}
+            for line in filter(None, output.split('\n')):
+                object_name, peeled_name, ref_name = line.split(' ', 2)
+                self._refs[ref_name] = peeled_name or object_name
+        return self._refs
+
+    def invalidate_refs(self):
+        self._refs = None
+
+    def get_ref(self, ref_name):
+        """
+        Look up a fully-qualified ref (eg `refs/tags/1.0.0`) in the ref table
+        :param str ref_name:
+        :return: str|None
+        """
+        return self.refs.get(ref_name)
+
+    def get_tags(self):
+        """
+        :return: list[str]
+        """
+        return [ref_name[len('refs/tags/'):] for ref_name in self.refs if ref_name.startswith('refs/tags/')]
+
+    def resolve_commits(self, revisions):
+        """
+        Resolve many revisions to commit hashes in a single `git cat-file --batch-check` process
+        :param list[str] revisions:
+        :return: dict[str, str|None] Revision to commit hash, or None if it does not name a commit
+        """
+        revisions = list(revisions)
+        if len(revisions) == 0:
+            return {}
+        output = self.execute(
+            'cat-file', '--batch-check=%(objectname) %(objecttype)',
+            stdin=''.join(f'{revision}^{{commit}}\n' for revision in revisions),
+        )
+        ret = {}
+        for revision, line in zip(revisions, output.split('\n')):
+            parts = line.split(' ')
+            ret[revision] = parts[0] if len(parts) == 2 and parts[1] == 'commit' else None
+        return ret
+
+    def resolve_commit(self, revision):
+        return self.resolve_commits([revision])[revision]
+
+    def execute(self, *args, suppress_errors=False, stdin=None):
+        """
+        Run a git command in the repository, without a shell
+        :param str args: Arguments to `git`
+        :param bool suppress_errors: Discard stderr rather than including it in the output
+        :param str stdin: Input to pass to the command
+        :return: str
+        """
+        stderr = subprocess.DEVNULL if suppress_errors else subprocess.STDOUT
+        return subprocess.check_output(
+            ['git', *args],
+            cwd=self._git_dir,
+            stderr=stderr,
+            input=stdin.encode('utf-8') if stdin is not None else None,
+        ).decode('utf-8').strip()
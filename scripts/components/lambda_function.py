@@ -1,10 +1,18 @@
 from colorama import Fore
-import boto3
 from botocore.exceptions import ClientError
 
+from components import aws
+from components.exceptions import ApplicationException
+from components.lambda_inventory import LambdaInventory
+from components.lambda_permissions import PermissionReconciler
+from components.retry import RetryPolicy
 from components.ui import cprint
 
 
+class UpdateInProgressException(Exception):
+    pass
+
+
 class LambdaFunction:
     def __init__(self, *, region_name, environment_name, service_name, function_name, s3_filepath):
         self.service_name = service_name
@@ -13,28 +21,42 @@ class LambdaFunction:
         self._name = function_name
         self._s3_filepath = s3_filepath
 
-        self._lambda_client = boto3.client('lambda')
+        self._lambda_client = aws.get_client('lambda')
+        self._s3_client = aws.get_client('s3')
+        self._inventory = LambdaInventory(self._lambda_client, self._name)
+        self._permissions = PermissionReconciler(self._lambda_client, self._name)
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def inventory(self) -> LambdaInventory:
+        return self._inventory
+
+    def __str__(self):
+        return self._name
+
     def get_latest_version(self):
-        return self._get_all_versions()[-1][1]
+        return self._inventory.get_latest_version()
 
-    def create_alias(self, semantic_version, lambda_version=None):
+    def create_alias(self, semantic_version, lambda_version=None, function_version=None):
         """
         Create a new lambda alias
         :param VersionInfo|str semantic_version:
-        :param VersionInfo|str lambda_version:
+        :param VersionInfo|str lambda_version: The semantic version of an existing alias, or a published version
+                                               number, to point the new alias at
+        :param str function_version: The function version to point the new alias at
         :return:
         """
         alias_name = self.semantic_version_to_alias_name(semantic_version)
 
-        if lambda_version is None:
+        if function_version is not None:
+            lambda_version = function_version
+        elif lambda_version is None:
             lambda_version = self.get_latest_version()
         else:
-            lambda_version = self._get_version_of_alias(self.semantic_version_to_alias_name(lambda_version))
+            lambda_version = self._get_version_of_qualifier(self.semantic_version_to_alias_name(lambda_version))
 
         cprint(f'Tagging version {self.name}:{lambda_version} as alias {alias_name}', colour=Fore.CYAN)
 
@@ -54,6 +76,7 @@ class LambdaFunction:
                 )
             else:
                 raise
+        self._inventory.set_alias(alias_name, lambda_version)
 
     def delete_alias(self, semantic_version):
         """
@@ -72,57 +95,32 @@ class LambdaFunction:
                 cprint(f'Lambda alias {self.name}:{alias_name} does not exist', colour=Fore.YELLOW)
             else:
                 raise
+        self._inventory.remove_alias(alias_name)
+        # The alias's resource policy went with it
+        self._permissions.invalidate(alias_name)
 
     def add_apigateway_permission(self, semantic_version, apigateway):
         alias_name = self.semantic_version_to_alias_name(semantic_version)
-
-        try:
-            self._lambda_client.add_permission(
-                FunctionName=self._name,
-                StatementId=f'{apigateway.id}_{alias_name}',
-                Action='lambda:InvokeFunction',
-                Principal='apigateway.amazonaws.com',
-                SourceArn=f'arn:aws:execute-api:{self.region_name}:887689817172:{apigateway.id}/*',
-                Qualifier=alias_name
-            )
-        except ClientError as e:
-            if 'ResourceConflictException' in str(e):
-                cprint(f'Permission already exists for {apigateway.id}/* on {self.name}:{alias_name}', colour=Fore.YELLOW)
-            else:
-                raise
+        self._permissions.reconcile(alias_name, {
+            f'{apigateway.id}_{alias_name}': ('apigateway.amazonaws.com', f'arn:aws:execute-api:{self.region_name}:887689817172:{apigateway.id}/*'),
+        })
 
     def remove_apigateway_permission(self, semantic_version, apigateway):
         alias_name = self.semantic_version_to_alias_name(semantic_version)
-
-        try:
-            self._lambda_client.remove_permission(
-                FunctionName=self._name,
-                StatementId=f'{apigateway.id}_{alias_name}',
-                Qualifier=alias_name
-            )
-        except ClientError as e:
-            if 'ResourceNotFound' in str(e):
-                cprint(f'No existing permission for {apigateway.id}/* on {self.name}:{alias_name}', colour=Fore.YELLOW)
-            else:
-                raise
+        if not self._permissions.remove(alias_name, f'{apigateway.id}_{alias_name}'):
+            cprint(f'No existing permission for {apigateway.id}/* on {self.name}:{alias_name}', colour=Fore.YELLOW)
 
     def add_s3_permission(self, semantic_version, s3):
         alias_name = self.semantic_version_to_alias_name(semantic_version)
+        self._permissions.reconcile(alias_name, {
+            f's3_{alias_name}': ('s3.amazonaws.com', f'arn:aws:s3:::{s3.name}'),
+        })
 
-        try:
-            self._lambda_client.add_permission(
-                FunctionName=self._name,
-                StatementId=f's3_{alias_name}',
-                Action='lambda:InvokeFunction',
-                Principal='s3.amazonaws.com',
-                SourceArn=f'arn:aws:s3:::{s3._name}',
-                Qualifier=alias_name
-            )
-        except ClientError as e:
-            if 'ResourceConflictException' in str(e):
-                cprint(f'Permission already exists for {s3.name}/* on {self.name}:{alias_name}', colour=Fore.YELLOW)
-            else:
-                raise
+    def get_policy_headroom_report(self):
+        """
+        :return: list[(str, int, int)] The qualifier, resource policy size and size limit of each alias examined
+        """
+        return self._permissions.get_headroom_report()
 
     def update_alias(self, semantic_version, target_alias):
         """
@@ -132,7 +130,7 @@ class LambdaFunction:
         :return:
         """
         alias_name = self.semantic_version_to_alias_name(semantic_version)
-        target_version = self._get_version_of_alias(self.semantic_version_to_alias_name(target_alias))
+        target_version = self._get_version_of_qualifier(self.semantic_version_to_alias_name(target_alias))
         cprint(f'Updating {self.name}:{alias_name} to {target_version}', colour=Fore.CYAN)
         try:
             self._lambda_client.update_alias(
@@ -150,37 +148,124 @@ class LambdaFunction:
                 )
             else:
                 raise
+        self._inventory.set_alias(alias_name, target_version)
 
     def update_code(self, ref, publish_version=False):
+        """
+        Update the function's code to the bundle for a given commit, and wait for the update to finish
+        :param str ref: The commit hash of the bundle
+        :param bool publish_version: Whether to publish a new version containing the bundle
+        :return: str|None The published version
+        """
+        s3_bucket = 'biometrix-infrastructure-{}'.format(self.region_name)
         s3_filepath = 'lambdas/{}/{}/{}'.format(self.service_name, ref, self._s3_filepath)
-        cprint(f'Updating Lambda {self._name} with bundle s3://{s3_filepath}', colour=Fore.CYAN)
-        res = self._lambda_client.update_function_code(
-            FunctionName=self._name,
-            S3Bucket='biometrix-infrastructure-{}'.format(self.region_name),
-            S3Key=s3_filepath,
-            Publish=publish_version
-        )
+        bundle_sha256 = self._get_bundle_sha256(s3_bucket, s3_filepath)
+
+        configuration = self.wait_for_update()
+        if bundle_sha256 is not None and configuration['CodeSha256'] == bundle_sha256:
+            cprint(f'Lambda {self._name} is already running bundle s3://{s3_filepath}', colour=Fore.CYAN)
+        else:
+            cprint(f'Updating Lambda {self._name} with bundle s3://{s3_filepath}', colour=Fore.CYAN)
+            res = self._lambda_client.update_function_code(
+                FunctionName=self._name,
+                S3Bucket=s3_bucket,
+                S3Key=s3_filepath,
+                Publish=False
+            )
+            bundle_sha256 = res['CodeSha256']
+            self.wait_for_update()
+
         if publish_version:
-            cprint(f"Published lambda version {res['Version']}")
+            version = self.publish_version(bundle_sha256)
+            cprint(f"Published lambda version {version}")
+            return version
+
+    def wait_for_update(self, timeout=300, delay=1, max_delay=10):
+        """
+        Wait until any in-progress update to the function has finished
+        :param int timeout: The maximum number of seconds to wait
+        :param float delay: The minimum delay between checks
+        :param float max_delay: The maximum delay between checks
+        :return: dict The function configuration
+        """
+        def check():
+            configuration = self._lambda_client.get_function_configuration(FunctionName=self._name)
+            if configuration.get('LastUpdateStatus') == 'Failed':
+                raise ApplicationException(f"Update of Lambda {self._name} failed: {configuration.get('LastUpdateStatusReason')}")
+            if configuration.get('LastUpdateStatus', 'Successful') != 'Successful' or configuration.get('State', 'Active') == 'Pending':
+                raise UpdateInProgressException()
+            return configuration
+
+        def on_deadline(_):
+            raise ApplicationException(f'Update of Lambda {self._name} not completed after {timeout} seconds')
+
+        policy = RetryPolicy(base_delay=delay, max_delay=max_delay, timeout=timeout, on_deadline=on_deadline)
+        return policy.call(check, exceptions=UpdateInProgressException)
 
-    def publish_version(self):
+    def publish_version(self, code_sha256=None):
+        """
+        Publish a new version of the function
+        :param str code_sha256: If given, only publish if the function's code has this hash
+        :return: str
+        """
+        kwargs = {'CodeSha256': code_sha256} if code_sha256 is not None else {}
         res = self._lambda_client.publish_version(
-            FunctionName=self._name
+            FunctionName=self._name,
+            **kwargs
         )
+        self._inventory.add_version(res)
         return res['Version']
 
-    def _get_version_of_alias(self, alias_name):
-        return self._lambda_client.get_function(FunctionName=self._name, Qualifier=alias_name)['Configuration']['Version']
+    def get_unreferenced_versions(self, referenced_aliases=(), keep_last=0):
+        """
+        Find published versions which no alias points to and which are not among the most recent
+        :param iterable[str] referenced_aliases: Additional alias names or version numbers which are in use
+        :param int keep_last: The number of most recent versions to keep regardless
+        :return: list[dict] The configurations of the unreferenced versions
+        """
+        referenced = set(self._inventory.aliases.values())
+        for alias_name in referenced_aliases:
+            referenced.add(self._inventory.aliases.get(alias_name, alias_name))
+
+        versions = sorted(self._inventory.versions, key=int)
+        if keep_last > 0:
+            referenced.update(versions[-keep_last:])
+        return [self._inventory.versions[v] for v in versions if v not in referenced]
 
-    def _get_all_versions(self, next_marker=None):
-        if next_marker is not None:
-            res = self._lambda_client.list_versions_by_function(FunctionName=self._name, Marker=next_marker)
-        else:
-            res = self._lambda_client.list_versions_by_function(FunctionName=self._name)
-        ret = [(v['LastModified'], v['Version']) for v in res['Versions'] if v['Version'] != '$LATEST']
-        if 'NextMarker' in res:
-            ret += self._get_all_versions(res['NextMarker'])
-        return sorted(ret)
+    def delete_version(self, version):
+        """
+        Delete a published version
+        :param str version:
+        """
+        try:
+            self._lambda_client.delete_function(FunctionName=self._name, Qualifier=version)
+        except ClientError as e:
+            if 'ResourceNotFound' in str(e):
+                cprint(f'Lambda version {self.name}:{version} does not exist', colour=Fore.YELLOW)
+            else:
+                raise
+        self._inventory.remove_version(version)
+
+    def _get_bundle_sha256(self, s3_bucket, s3_key):
+        """
+        Get the base64-encoded SHA-256 hash of a bundle in S3, in the same format as Lambda's `CodeSha256`, if it was
+        recorded in the object's metadata when it was uploaded
+        :return: str|None
+        """
+        res = self._s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+        return res.get('Metadata', {}).get('codesha256')
+
+    def _get_version_of_qualifier(self, qualifier):
+        """
+        The published version an alias name or version number refers to
+        """
+        if qualifier in self._inventory.versions:
+            return qualifier
+        version = self._inventory.get_version_of_alias(qualifier)
+        if version is not None:
+            return version
+        # Not known to the inventory (eg `$LATEST`), so ask Lambda, which also raises if it does not exist
+        return self._lambda_client.get_function(FunctionName=self._name, Qualifier=qualifier)['Configuration']['Version']
 
     @staticmethod
     def semantic_version_to_alias_name(semantic_version):
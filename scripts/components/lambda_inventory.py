@@ -0,0 +1,80 @@
+class LambdaInventory:
+    """
+    The published versions and aliases of a Lambda function, listed once and then kept up to date in memory as the
+    deploy changes them
+    """
+    def __init__(self, lambda_client, function_name):
+        self._lambda_client = lambda_client
+        self._function_name = function_name
+        self._versions = None
+        self._aliases = None
+
+    @property
+    def versions(self):
+        """
+        :return: dict[str, dict] Published version numbers (excluding $LATEST) mapped to their configurations
+        """
+        if self._versions is None:
+            self._versions = {
+                v['Version']: v
+                for v in self._list_all('list_versions_by_function', 'Versions')
+                if v['Version'] != '$LATEST'
+            }
+        return self._versions
+
+    @property
+    def aliases(self):
+        """
+        :return: dict[str, str] Alias names mapped to the version they point to
+        """
+        if self._aliases is None:
+            self._aliases = {a['Name']: a['FunctionVersion'] for a in self._list_all('list_aliases', 'Aliases')}
+        return self._aliases
+
+    def get_latest_version(self):
+        """
+        :return: str|None The most recently published version
+        """
+        if len(self.versions) == 0:
+            return None
+        return max(self.versions, key=int)
+
+    def get_version_of_alias(self, alias_name):
+        """
+        :return: str|None
+        """
+        return self.aliases.get(alias_name)
+
+    def set_alias(self, alias_name, version):
+        if self._aliases is not None:
+            self._aliases[alias_name] = version
+
+    def remove_alias(self, alias_name):
+        if self._aliases is not None:
+            self._aliases.pop(alias_name, None)
+
+    def add_version(self, configuration):
+        """
+        Record a newly-published version
+        :param dict configuration: The response from `publish_version`
+        """
+        if self._versions is not None:
+            self._versions[configuration['Version']] = configuration
+
+    def remove_version(self, version):
+        if self._versions is not None:
+            self._versions.pop(version, None)
+
+    def invalidate(self):
+        self._versions = None
+        self._aliases = None
+
+    def _list_all(self, operation, key):
+        ret = []
+        kwargs = {'FunctionName': self._function_name}
+        while True:
+            res = getattr(self._lambda_client, operation)(**kwargs)
+            ret += res[key]
+            if 'NextMarker' not in res:
+                return ret
+            kwargs['Marker'] = res['NextMarker']
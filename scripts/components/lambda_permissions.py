@@ -0,0 +1,123 @@
+from botocore.exceptions import ClientError
+from colorama import Fore
+import json
+import threading
+
+from components.ui import cprint
+
+# The maximum size of a Lambda function's resource policy
+POLICY_SIZE_LIMIT = 20480
+
+
+class PermissionReconciler:
+    """
+    Reads the resource policy of each qualifier of a Lambda function once, and adds or removes only the
+    statements which differ from what is wanted
+    """
+    def __init__(self, lambda_client, function_name):
+        self._lambda_client = lambda_client
+        self._function_name = function_name
+        self._policies = {}
+        self._lock = threading.Lock()
+
+    def get_statements(self, qualifier):
+        """
+        :param str qualifier: The alias or version
+        :return: dict[str, dict] The statements in the qualifier's resource policy, by Sid
+        """
+        with self._lock:
+            if qualifier not in self._policies:
+                try:
+                    policy = json.loads(self._lambda_client.get_policy(FunctionName=self._function_name, Qualifier=qualifier)['Policy'])
+                    self._policies[qualifier] = {s['Sid']: s for s in policy.get('Statement', [])}
+                except ClientError as e:
+                    if 'ResourceNotFound' in str(e):
+                        self._policies[qualifier] = {}
+                    else:
+                        raise
+            return self._policies[qualifier]
+
+    def reconcile(self, qualifier, desired):
+        """
+        Make a qualifier's resource policy contain the desired statements
+        :param str qualifier: The alias or version
+        :param dict[str, (str, str)] desired: Statement ids mapped to the (principal, source ARN) they should allow
+        """
+        existing = self.get_statements(qualifier)
+        for sid, (principal, source_arn) in desired.items():
+            if sid in existing:
+                if _statement_matches(existing[sid], principal, source_arn):
+                    continue
+                self.remove(qualifier, sid)
+            try:
+                self._lambda_client.add_permission(
+                    FunctionName=self._function_name,
+                    StatementId=sid,
+                    Action='lambda:InvokeFunction',
+                    Principal=principal,
+                    SourceArn=source_arn,
+                    Qualifier=qualifier
+                )
+            except ClientError as e:
+                if 'ResourceConflictException' not in str(e):
+                    raise
+                cprint(f'Permission {sid} already exists on {self._function_name}:{qualifier}', colour=Fore.YELLOW)
+            existing[sid] = _make_statement(sid, principal, source_arn)
+
+        size, limit = self.get_headroom(qualifier)
+        if size > limit * 0.8:
+            cprint(f'Resource policy for {self._function_name}:{qualifier} is {size} of {limit} bytes', colour=Fore.YELLOW)
+
+    def remove(self, qualifier, sid):
+        """
+        Remove a statement from a qualifier's resource policy, if it is there
+        :return: bool Whether a statement was removed
+        """
+        existing = self.get_statements(qualifier)
+        if sid not in existing:
+            return False
+        try:
+            self._lambda_client.remove_permission(FunctionName=self._function_name, StatementId=sid, Qualifier=qualifier)
+        except ClientError as e:
+            if 'ResourceNotFound' not in str(e):
+                raise
+        existing.pop(sid, None)
+        return True
+
+    def invalidate(self, qualifier):
+        """
+        Forget the cached resource policy of a qualifier, eg because the alias has been deleted
+        """
+        with self._lock:
+            self._policies.pop(qualifier, None)
+
+    def get_headroom(self, qualifier):
+        """
+        :return: (int, int) The approximate size of the qualifier's resource policy, and the size limit
+        """
+        statements = list(self.get_statements(qualifier).values())
+        size = len(json.dumps({'Version': '2012-10-17', 'Id': 'default', 'Statement': statements}, separators=(',', ':')))
+        return size, POLICY_SIZE_LIMIT
+
+    def get_headroom_report(self):
+        """
+        :return: list[(str, int, int)] The qualifier, policy size and limit for every policy read so far
+        """
+        return [(qualifier, *self.get_headroom(qualifier)) for qualifier in sorted(self._policies)]
+
+
+def _statement_matches(statement, principal, source_arn):
+    return (
+        statement.get('Principal', {}).get('Service') == principal
+        and statement.get('Condition', {}).get('ArnLike', {}).get('AWS:SourceArn') == source_arn
+    )
+
+
+def _make_statement(sid, principal, source_arn):
+    return {
+        'Sid': sid,
+        'Effect': 'Allow',
+        'Principal': {'Service': principal},
+        'Action': 'lambda:InvokeFunction',
+        'Condition': {'ArnLike': {'AWS:SourceArn': source_arn}},
+    }
@@ -1,27 +1,38 @@
-from boto3.dynamodb.conditions import Key, Attr
+from collections import OrderedDict
 from colorama import Fore
-from semver import VersionInfo
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from subprocess import CalledProcessError
-import boto3
 import json
 import os
 import re
-import subprocess
+import threading
 import time
 
+from components import aws
 from components.exceptions import ApplicationException
-from components.ui import cprint, Spinner
+from components.git import Git
+from components.retry import RetryPolicy
+from components.semver_index import SemverIndex
+from components.ui import cprint
 
-lambci_builds_table = boto3.resource('dynamodb', region_name='us-east-1').Table('infrastructure-lambci-builds')
+# LRU cache of completed (and therefore immutable) build records, keyed by (project, buildNum)
+_completed_builds = OrderedDict()
+_completed_builds_max_size = 256
 
 # https://github.com/semver/semver/issues/232#issuecomment-405596809
 semver_regex = '^(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)(?:-((?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*))?(?:\+([0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?$'
 
 
+class BuildInProgressException(Exception):
+    pass
+
+
 class Repository(object):
     def __init__(self, service):
         self.service = service
         self._git_dir = self._get_git_dir()
+        self._git = Git.for_directory(self._git_dir)
+        self._semver_index = None
 
     @property
     def git_repo_name(self):
@@ -40,69 +51,89 @@ class Repository(object):
         """
         Get the LambCI build number corresponding to a particular version
         :param str version:
-        :return: str
+        :return: int
         """
-        builds = lambci_builds_table.query(
-            KeyConditionExpression=Key('project').eq(self.lambci_project_name),
-            FilterExpression=Attr('commit').eq(version),
-            ScanIndexForward=False,
-        )['Items']
-        if len(builds) == 0:
+        from boto3.dynamodb.conditions import Key
+
+        build_numbers = []
+        kwargs = {
+            'IndexName': 'commit',
+            'KeyConditionExpression': Key('project').eq(self.lambci_project_name) & Key('commit').eq(version),
+        }
+        while True:
+            res = get_lambci_builds_table().query(**kwargs)
+            build_numbers += [b['buildNum'] for b in res['Items']]
+            if 'LastEvaluatedKey' not in res:
+                break
+            kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+        if len(build_numbers) == 0:
             raise ApplicationException(f'No build has been started for {version}.  Have you pushed your changes?')
-        elif len(builds) > 1:
+        elif len(build_numbers) > 1:
             cprint(f'Multiple builds found for version {version}, using most recent', colour=Fore.YELLOW)
-            return max([b['buildNum'] for b in builds])
-        else:
-            return builds[0]['buildNum']
+        return self.get_build(max(build_numbers))['buildNum']
 
-    def get_build_status(self, build_number):
+    def get_build(self, build_number):
         """
-        Check the status of the LambCI build for a given version, by querying the `infrastructure-lambci-builds`
-        DynamoDB table.
+        Get the LambCI build record for a given build number.  Completed builds are immutable, so are cached.
 
-        :param str build_number: The build_number to check
-        :return: str
+        :param int build_number:
+        :return: dict
         """
-        kcx = Key('project').eq(self.lambci_project_name) & Key('buildNum').eq(build_number)
-        builds = lambci_builds_table.query(KeyConditionExpression=kcx)['Items']
-        if len(builds) == 0:
+        key = (self.lambci_project_name, build_number)
+        if key in _completed_builds:
+            _completed_builds.move_to_end(key)
+            return _completed_builds[key]
+
+        build = get_lambci_builds_table().get_item(
+            Key={'project': self.lambci_project_name, 'buildNum': build_number},
+            ConsistentRead=True,
+        ).get('Item')
+        if build is None:
             raise ApplicationException('Unrecognised build number')
-        else:
-            return builds[0]['status']
 
-    def await_build_completion(self, version):
+        if build['status'] in ['success', 'failure']:
+            _completed_builds[key] = build
+            if len(_completed_builds) > _completed_builds_max_size:
+                _completed_builds.popitem(last=False)
+        return build
+
+    def get_build_status(self, build_number):
         """
-        Wait until the LambCI build for a given git version has completed
+        Check the status of the LambCI build for a given version, by reading the build record from the
+        `infrastructure-lambci-builds` DynamoDB table.
 
-        :param str version: The full commit hash of the version to check
+        :param int build_number: The build_number to check
+        :return: str
         """
-        spinner = Spinner()
-        try:
-            counts = 12
-            build_number = self.get_build_number_for_version(version)
-            cprint(f'Waiting for CI build completion for {version} (#{build_number}) ', colour=Fore.CYAN, end="")
-            spinner.start()
-
-            while counts >= 0:
-                build_status = self.get_build_status(build_number)
-
-                if build_status == 'success':
-                    cprint("\b \r\nBuild complete                        ", colour=Fore.GREEN)
-                    break
-                elif build_status == 'failure':
-                    cprint("\b \r\nBuild was not successful                        ", colour=Fore.RED)
-                    exit(1)
-                else:
-                    counts -= 1
-                    time.sleep(5)
-                    continue
-            else:
-                cprint("\b \r\nBuild not completed after 60 seconds                        ", colour=Fore.RED)
-                exit(1)
-
-        finally:
-            spinner.stop()
-            cprint('')
+        return self.get_build(build_number)['status']
+
+    def wait_for_build(self, build_number, timeout=900, delay=2, max_delay=15, on_progress=None):
+        """
+        Block until a LambCI build reaches a terminal status, polling with a growing delay between reads
+
+        :param int build_number: The build to wait for
+        :param int timeout: The maximum number of seconds to wait
+        :param float delay: The minimum delay between status checks
+        :param float max_delay: The maximum delay between status checks
+        :param callable on_progress: Called with (status, elapsed_seconds) after each check
+        :return: str 'success' or 'failure'
+        """
+        start = time.monotonic()
+
+        def check():
+            build_status = self.get_build_status(build_number)
+            if on_progress is not None:
+                on_progress(build_status, time.monotonic() - start)
+            if build_status not in ['success', 'failure']:
+                raise BuildInProgressException()
+            return build_status
+
+        def on_deadline(_):
+            raise ApplicationException(f'Build #{build_number} for {self.service} not completed after {timeout} seconds')
+
+        policy = RetryPolicy(base_delay=delay, max_delay=max_delay, timeout=timeout, on_deadline=on_deadline)
+        return policy.call(check, exceptions=BuildInProgressException)
 
     def parse_ref(self, version):
         """
@@ -119,42 +150,61 @@ class Repository(object):
 
         elif re.match('^[0-9a-f]{40}$', version):
             # Already a full commit hash
-            try:
-                self._execute_git_command(f'git branch --contains {version}')
-                return version, 'commit'
-            except CalledProcessError:
+            if self._git.resolve_commit(version) is None:
                 raise ApplicationException(f'Commit {version} does not exist')
+            return version, 'commit'
 
         elif version == 'HEAD':
-            try:
-                version = self._execute_git_command(f'git rev-parse HEAD')
-                return version, 'head'
-            except CalledProcessError:
+            commit = self._git.resolve_commit('HEAD')
+            if commit is None:
                 raise ApplicationException(f'Commit {version} does not exist')
+            return commit, 'head'
 
         else:
-            try:
-                # Parse the value as a branch name and get the associated git commit hash
-                x2 = self._execute_git_command(f'git show-ref --verify refs/tags/{version}', True).split(' ')[0]
-                cprint(f"Tag '{version}' has commit hash {x2}", colour=Fore.GREEN)
-                return x2, 'tag'
-            except CalledProcessError:
-                try:
-                    # Parse the value as a branch name and get the associated git commit hash
-                    x2 = self._execute_git_command(f'git show-ref --verify refs/heads/{version}', True).split(' ')[0]
-                    cprint(f"Branch '{version}' has commit hash {x2}", colour=Fore.GREEN)
-                    return x2, 'branch'
-                except CalledProcessError:
-                    raise ApplicationException('Version must be a 40-hex-digit git hash or valid branch or tag name')
-
-    def compare_remote_status(self, branch_name):
+            tag_commit = self._git.get_ref(f'refs/tags/{version}')
+            if tag_commit is not None:
+                cprint(f"Tag '{version}' has commit hash {tag_commit}", colour=Fore.GREEN)
+                return tag_commit, 'tag'
+
+            branch_commit = self._git.get_ref(f'refs/heads/{version}')
+            if branch_commit is not None:
+                cprint(f"Branch '{version}' has commit hash {branch_commit}", colour=Fore.GREEN)
+                return branch_commit, 'branch'
+
+            raise ApplicationException('Version must be a 40-hex-digit git hash or valid branch or tag name')
+
+    def fetch_branch(self, branch_name):
+        """
+        Fetch a single branch, and the tags, from the remote, negotiating only against the local history of that
+        branch and the tags
+        :param str branch_name:
+        """
+        self._execute_git_command(
+            'fetch', '--tags', f'--negotiation-tip=refs/heads/{branch_name}', '--negotiation-tip=refs/tags/*',
+            'origin', f'+refs/heads/{branch_name}:refs/remotes/origin/{branch_name}'
+        )
+        self._invalidate_tags()
+
+    def fetch_tags(self):
+        """
+        Fetch the tags from the remote, so that new versions are checked against the tags others have pushed
+        """
+        self._execute_git_command('fetch', '--tags', '--negotiation-tip=refs/tags/*', 'origin')
+        self._invalidate_tags()
+
+    def _invalidate_tags(self):
+        self._git.invalidate_refs()
+        self._semver_index = None
+
+    def compare_remote_status(self, branch_name, fetch=True):
         """
         Check whether the local version of a branch is behind, level with or ahead of the remote
         :param str branch_name:
+        :param bool fetch: Whether to fetch the branch from the remote first
         :return: int
         """
-        # Update remotes first
-        self._execute_git_command('git remote update')
+        if fetch:
+            self.fetch_branch(branch_name)
 
         return self.compare_refs(branch_name, f'origin/{branch_name}')
 
@@ -165,19 +215,14 @@ class Repository(object):
         :param str ref2:
         :return: int
         """
+        # Commits reachable only from ref1, and only from ref2
+        ahead, behind = map(int, self._execute_git_command('rev-list', '--left-right', '--count', f'{ref1}...{ref2}').split())
 
-        local_ref = self._execute_git_command(f'git rev-parse {ref1}')
-
-        remote_ref = self._execute_git_command(f'git rev-parse {ref2}')
-
-        # The first common ancestor of the local and remote branches
-        parent_ref = self._execute_git_command(f'git merge-base {ref1} {ref2}')
-
-        if local_ref == remote_ref:
+        if ahead == 0 and behind == 0:
             return 0  # Branches are equal
-        elif local_ref == parent_ref:
+        elif ahead == 0:
             return -1  # The remote is ahead of local
-        elif remote_ref == parent_ref:
+        elif behind == 0:
             return 1  # The local ref is ahead of remote
         else:
             raise ApplicationException(f'Branch {ref1} has diverged from {ref2}')
@@ -190,8 +235,9 @@ class Repository(object):
         :param str version: The commit hash of the commit to move to
         """
         try:
-            self._execute_git_command(f"git update-ref refs/heads/{branch_name} {version}")
-            self._execute_git_command(f"git push origin {branch_name} --force")
+            self._execute_git_command('update-ref', f'refs/heads/{branch_name}', version)
+            self._git.invalidate_refs()
+            self._execute_git_command('push', 'origin', branch_name, '--force')
         except CalledProcessError:
             cprint('Could not update git branch references.  Are your SSH keys set up properly?', colour=Fore.RED)
 
@@ -200,23 +246,28 @@ class Repository(object):
             config = json.load(f)
             return config
 
-    def get_semver_tags(self):
-        def make_semver(tag):
-            try:
-                return VersionInfo.parse(tag)
-            except ValueError:
-                return None
+    def get_semver_index(self):
+        """
+        :return: SemverIndex
+        """
+        if self._semver_index is None:
+            self._semver_index = SemverIndex.load(self._git)
+        return self._semver_index
 
-        all_tags = self._execute_git_command(f'git tag')
-        return list(filter(None, [make_semver(tag) for tag in all_tags.split('\n')]))
+    def get_semver_tags(self):
+        return self.get_semver_index().versions
 
     def create_semver_tag(self, tag, ref):
-        self._execute_git_command(f"git tag {tag} {ref}")
-        self._execute_git_command(f'git push origin {tag}')
+        self._execute_git_command('tag', str(tag), ref)
+        self._git.invalidate_refs()
+        self._semver_index = None
+        self._execute_git_command('push', 'origin', str(tag))
 
     def delete_tag(self, tag):
-        self._execute_git_command(f"git tag --delete {tag}")
-        self._execute_git_command(f'git push --delete origin {tag}')
+        self._execute_git_command('tag', '--delete', str(tag))
+        self._git.invalidate_refs()
+        self._semver_index = None
+        self._execute_git_command('push', '--delete', 'origin', str(tag))
 
     def _get_git_dir(self):
         try:
@@ -225,9 +276,8 @@ class Repository(object):
         except KeyError:
             raise ApplicationException(f'No Git repository configured for service {self.service}')
 
-    def _execute_git_command(self, command, suppress_errors=False):
-        stderr = subprocess.DEVNULL if suppress_errors else subprocess.STDOUT
-        return subprocess.check_output(command, cwd=self._git_dir, shell=True, stderr=stderr).decode('utf-8').strip()
+    def _execute_git_command(self, *args, suppress_errors=False):
+        return self._git.execute(*args, suppress_errors=suppress_errors)
 
     @property
     def lambci_project_name(self):
@@ -240,3 +290,70 @@ class Repository(object):
             'users': 'Users',
         }
         return f'gh/biometrixtech/{repository_names[self.service]}'
+
+
+def get_lambci_builds_table():
+    return aws.get_resource('dynamodb', 'us-east-1').Table('infrastructure-lambci-builds')
+
+
+def compare_remote_statuses(branches):
+    """
+    Fetch several repositories' branches in parallel, then compare each with its remote
+
+    :param list[(Repository, str)] branches: Pairs of repository and branch name
+    :return: list[int] The result of `compare_remote_status()` for each branch, in order
+    """
+    with ThreadPoolExecutor(max_workers=max(len(branches), 1)) as executor:
+        for future in [executor.submit(repository.fetch_branch, branch_name) for repository, branch_name in branches]:
+            future.result()
+    return [repository.compare_remote_status(branch_name, fetch=False) for repository, branch_name in branches]
+
+
+def await_build_completions(builds, timeout=900):
+    """
+    Wait until the LambCI builds for several repositories have all completed, showing live progress
+
+    :param list[(Repository, str)] builds: Pairs of repository and full commit hash to wait for
+    :param int timeout: The maximum number of seconds to wait for any one build
+    """
+    builds = [(repository, version, repository.get_build_number_for_version(version)) for repository, version in builds]
+    progress = {(repository.service, build_number): ('pending', 0) for repository, _, build_number in builds}
+    lock = threading.Lock()
+    # Set when one wait fails, so that the others stop at their next check instead of running to their own timeouts
+    cancelled = threading.Event()
+
+    def print_progress():
+        line = ', '.join(f'{service}#{build_number}: {status} ({elapsed:.0f}s)' for (service, build_number), (status, elapsed) in progress.items())
+        cprint(f'\r\033[K{line} ', colour=Fore.CYAN, end='')
+
+    def wait(repository, build_number):
+        def on_progress(status, elapsed):
+            if cancelled.is_set():
+                raise ApplicationException(f'Stopped waiting for build #{build_number} for {repository.service}')
+            with lock:
+                progress[(repository.service, build_number)] = (status, elapsed)
+                print_progress()
+        return repository.wait_for_build(build_number, timeout=timeout, on_progress=on_progress)
+
+    for repository, version, build_number in builds:
+        cprint(f'Waiting for CI build completion for {repository.service} {version} (#{build_number})', colour=Fore.CYAN)
+
+    executor = ThreadPoolExecutor(max_workers=len(builds))
+    try:
+        futures = {executor.submit(wait, repository, build_number): (repository, build_number) for repository, _, build_number in builds}
+        failures = []
+        for future in as_completed(futures):
+            repository, build_number = futures[future]
+            if future.result() != 'success':
+                failures.append(f'{repository.service}#{build_number}')
+    except ApplicationException as e:
+        cancelled.set()
+        executor.shutdown(wait=False)
+        cprint(f'\r\033[K{e}', colour=Fore.RED)
+        exit(1)
+    executor.shutdown()
+
+    if failures:
+        cprint(f'\r\033[KBuild was not successful: {", ".join(failures)}', colour=Fore.RED)
+        exit(1)
+    cprint('\r\033[KBuild complete', colour=Fore.GREEN)
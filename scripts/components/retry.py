@@ -0,0 +1,80 @@
+import random
+import time
+
+
+class RetryPolicy:
+    """
+    Retries a call with exponentially growing, decorrelated-jitter delays, giving up after a number of attempts or
+    when a deadline would be passed
+    """
+    def __init__(self, *, base_delay=1, max_delay=30, max_attempts=None, timeout=None, deadline=None, on_deadline=None):
+        """
+        :param float base_delay: The minimum delay between attempts
+        :param float max_delay: The maximum delay between attempts
+        :param int max_attempts: The maximum number of attempts, or None for no limit
+        :param float timeout: Seconds from now after which to give up
+        :param float deadline: Absolute `time.time()` after which to give up; the earlier of this and `timeout` is used
+        :param callable on_deadline: Called with the last exception when giving up because of the deadline; if it
+                                     does not raise, the last exception is re-raised
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        if timeout is not None:
+            self.deadline = min(filter(None, [deadline, time.time() + timeout]))
+        self.on_deadline = on_deadline
+
+    def with_options(self, **kwargs):
+        """
+        A copy of this policy, with the same deadline and hook unless they are among the options changed
+        """
+        options = dict(
+            base_delay=self.base_delay,
+            max_delay=self.max_delay,
+            max_attempts=self.max_attempts,
+            deadline=self.deadline,
+            on_deadline=self.on_deadline,
+        )
+        options.update(kwargs)
+        return RetryPolicy(**options)
+
+    def remaining(self):
+        """
+        :return: float|None Seconds until the deadline
+        """
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def next_delay(self, previous_delay):
+        """
+        Decorrelated jitter: somewhere between the base delay and three times the previous delay
+        """
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous_delay * 3)))
+
+    def call(self, f, *args, exceptions=Exception, retry_if=None, **kwargs):
+        """
+        Call a function, retrying it if it raises one of the given exceptions
+        :param callable f:
+        :param exceptions: An exception class or tuple of classes to retry on
+        :param callable retry_if: If given, only exceptions for which this returns True are retried
+        :return: The return value of f
+        """
+        attempt = 0
+        delay = self.base_delay
+        while True:
+            attempt += 1
+            try:
+                return f(*args, **kwargs)
+            except exceptions as e:
+                if retry_if is not None and not retry_if(e):
+                    raise
+                if self.max_attempts is not None and attempt >= self.max_attempts:
+                    raise
+
+                delay = self.next_delay(delay)
+                remaining = self.remaining()
+                if remaining is not None and remaining < delay:
+                    if self.on_deadline is not None:
+                        self.on_deadline(e)
+                    raise
+                time.sleep(delay)
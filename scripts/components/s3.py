@@ -1,7 +1,7 @@
 from colorama import Fore
-import boto3
-from botocore.exceptions import ClientError
+import re
 
+from components import aws
 from components.ui import cprint
 
 
@@ -13,54 +13,53 @@ class S3:
         self._name = bucket_name
         self._bucket_type = bucket_type
 
-        self._s3_client = boto3.client('s3')
+        self._s3_client = aws.get_client('s3')
 
     @property
     def name(self):
         return self._name
 
+    def reconcile_lambda_triggers(self, lambda_function):
+        """
+        Make the bucket's notifications trigger every major/minor alias of a lambda function (eg `1_2`, but not
+        `1_2_3` or `1_`), each for objects prefixed with `<alias>_lambda_version`.  Notifications for aliases which no
+        longer exist are removed, other notification configurations are preserved, and nothing is written if the
+        configuration is already correct.
+        """
+        function_arn = f'arn:aws:lambda:{self.region_name}:887689817172:function:{lambda_function.name}'
+        alias_names = sorted(a for a in lambda_function.inventory.aliases if re.match(r'^\d+_\d+$', a))
+        for alias_name in alias_names:
+            lambda_function.add_s3_permission(alias_name, self)
 
-    def add_lambda_trigger(self, semantic_version, lambda_function):
+        notification_configuration = self._s3_client.get_bucket_notification_configuration(Bucket=self.name)
+        del notification_configuration['ResponseMetadata']
+        lambda_configurations = notification_configuration.get('LambdaFunctionConfigurations', [])
 
-        lambda_function.add_s3_permission(semantic_version, self)
-        lambda_alias_name = self.semantic_version_to_alias_name(semantic_version)
-        existing_notification = self._s3_client.get_bucket_notification_configuration(
-            Bucket=self.name
-            )
-        existing_lambda_notifications = existing_notification.get('LambdaFunctionConfigurations', [])
-        existing_aliases = [la['LambdaFunctionArn'].split(':')[-1] for la in existing_lambda_notifications]
-        try:
-            if (
-                lambda_alias_name not in existing_aliases and  # does not currently exist
-                len(lambda_alias_name.split('_')) == 2 and lambda_alias_name[-1] != '_'):  # only update for new major/minor release not for patch or major_ only
-                new_lambda_notification = {
-                    'LambdaFunctionArn': f'arn:aws:lambda:{self.region_name}:887689817172:function:{lambda_function._name}:{lambda_alias_name}',
-                    'Events': ['s3:ObjectCreated:*'],
-                    'Filter': {
-                        'Key': {
-                            'FilterRules': [
-                                {
-                                    'Name': 'Prefix',
-                                    'Value': f'{lambda_alias_name}_lambda_version'
-                                },
-                            ]
-                        }
-                    }
+        other_configurations = [c for c in lambda_configurations if c['LambdaFunctionArn'].rsplit(':', 1)[0] != function_arn]
+        existing_configurations = {c['LambdaFunctionArn'].rsplit(':', 1)[1]: c for c in lambda_configurations if c not in other_configurations}
+        desired_configurations = [existing_configurations.get(alias_name) or {
+            'LambdaFunctionArn': f'{function_arn}:{alias_name}',
+            'Events': ['s3:ObjectCreated:*'],
+            'Filter': {
+                'Key': {
+                    'FilterRules': [
+                        {
+                            'Name': 'Prefix',
+                            'Value': f'{alias_name}_lambda_version'
+                        },
+                    ]
                 }
-                existing_lambda_notifications.append(new_lambda_notification)
-                del existing_notification['ResponseMetadata']
-                self._s3_client.put_bucket_notification_configuration(
-                        Bucket=self.name,
-                        NotificationConfiguration={'LambdaFunctionConfigurations': existing_lambda_notifications}
-                )
-        except ClientError as e:
-            if 'ResourceConflictException' in str(e):
-                cprint(e, colour=Fore.YELLOW)
-                # cprint(f'Permission already exists for /* on {self.name}:{alias_name}', colour=Fore.YELLOW)
-            else:
-                raise
+            }
+        } for alias_name in alias_names]
 
+        if sorted(existing_configurations) == alias_names:
+            return
 
-    @staticmethod
-    def semantic_version_to_alias_name(semantic_version):
-        return str(semantic_version).replace('.', '_')
+        added = sorted(set(alias_names) - set(existing_configurations))
+        removed = sorted(set(existing_configurations) - set(alias_names))
+        cprint(f'Updating notifications on {self.name} for {lambda_function.name} (adding {added}, removing {removed})', colour=Fore.CYAN)
+        notification_configuration['LambdaFunctionConfigurations'] = other_configurations + desired_configurations
+        self._s3_client.put_bucket_notification_configuration(
+            Bucket=self.name,
+            NotificationConfiguration=notification_configuration
+        )
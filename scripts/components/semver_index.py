@@ -0,0 +1,126 @@
+from bisect import bisect_right, insort
+from semver import VersionInfo
+import json
+import os
+
+
+class SemverIndex(object):
+    """
+    A sorted index of the semantic version tags in a repository
+    """
+    def __init__(self, versions):
+        self._versions = sorted(versions)
+
+    @classmethod
+    def from_tags(cls, tags):
+        """
+        Build an index from tag names, ignoring any which are not semantic versions
+        :param list[str] tags:
+        :return: SemverIndex
+        """
+        def make_semver(tag):
+            try:
+                return VersionInfo.parse(tag)
+            except ValueError:
+                return None
+
+        return cls(filter(None, [make_semver(tag) for tag in tags]))
+
+    @classmethod
+    def load(cls, git, cache_filename='semver_index.json'):
+        """
+        Load the index for a repository from a cache file in its .git directory, rebuilding the cache if the tags
+        may have changed since it was written
+        :param components.git.Git git:
+        :param str cache_filename:
+        :return: SemverIndex
+        """
+        dot_git = os.path.join(git.git_dir, '.git')
+        cache_path = os.path.join(dot_git, cache_filename)
+        cache_key = [_mtime(os.path.join(dot_git, 'packed-refs')), _mtime(os.path.join(dot_git, 'refs', 'tags'))]
+
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+            if cache['key'] == cache_key:
+                # Tags were validated when the cache was written, and are stored in order
+                index = cls([])
+                index._versions = [VersionInfo.parse(v) for v in cache['versions']]
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+
+        # The tags on disk have changed since the cache was written, so don't trust any in-memory ref table either
+        git.invalidate_refs()
+        index = cls.from_tags(git.get_tags())
+        try:
+            with open(cache_path, 'w') as f:
+                json.dump({'key': cache_key, 'versions': [str(v) for v in index.versions]}, f)
+        except OSError:
+            pass
+        return index
+
+    @property
+    def versions(self):
+        """
+        :return: list[VersionInfo] All versions, in ascending order
+        """
+        return list(self._versions)
+
+    def add(self, version):
+        if version not in self:
+            insort(self._versions, version)
+
+    def latest(self):
+        """
+        :return: VersionInfo|None
+        """
+        return self._versions[-1] if self._versions else None
+
+    def next_after(self, version):
+        """
+        The lowest version which is greater than the given one
+        :param VersionInfo version:
+        :return: VersionInfo|None
+        """
+        i = bisect_right(self._versions, version)
+        return self._versions[i] if i < len(self._versions) else None
+
+    def later_in_minor(self, version):
+        """
+        The lowest version greater than the given one with the same major and minor version
+        :param VersionInfo version:
+        :return: VersionInfo|None
+        """
+        later = self.next_after(version)
+        if later is not None and (later.major, later.minor) == (version.major, version.minor):
+            return later
+        return None
+
+    def later_in_major(self, version):
+        """
+        The lowest version greater than the given one with the same major version
+        :param VersionInfo version:
+        :return: VersionInfo|None
+        """
+        later = self.next_after(version)
+        if later is not None and later.major == version.major:
+            return later
+        return None
+
+    def __contains__(self, version):
+        i = bisect_right(self._versions, version)
+        return i > 0 and self._versions[i - 1] == version
+
+    def __len__(self):
+        return len(self._versions)
+
+    def __iter__(self):
+        return iter(self._versions)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
@@ -1,10 +1,14 @@
 from components.api_gateway import ApiGateway
+from components.concurrency import map_concurrently
 from components.lambda_function import LambdaFunction
 from components.repository import Repository
 from components.s3 import S3
 
 
 class Service(object):
+    # The maximum number of concurrent Lambda API operations
+    max_workers = 8
+
     def __init__(self, environment, service):
 
         self.environment = environment
@@ -33,9 +37,21 @@ class Service(object):
     def repository(self) -> Repository:
         return self._repository
 
-    def update_lambda_functions(self, ref, publish_tags=False):
-        for lambda_function in self._lambda_functions:
-            lambda_function.update_code(ref, publish_tags)
+    def update_lambda_functions(self, ref, publish_tags=False, alias_tag=None):
+        """
+        Update the code of all the service's lambda functions concurrently
+        :param str ref: The commit hash of the bundles to deploy
+        :param bool publish_tags: Whether to publish a new version of each function
+        :param VersionInfo|str alias_tag: If given, create this alias for each function once its update has finished
+        """
+        def update(lambda_function):
+            function_version = lambda_function.update_code(ref, publish_tags)
+            if alias_tag is not None:
+                lambda_function.create_alias(alias_tag, function_version=function_version)
+
+        map_concurrently(update, self._lambda_functions, max_workers=self.max_workers, description='Updating lambda functions')
+        if alias_tag is not None:
+            self._update_s3_triggers()
 
     def create_lambda_aliases(self, tag, from_tag=None):
         """
@@ -43,20 +59,39 @@ class Service(object):
         :param VersionInfo|str tag:
         :param VersionInfo|str from_tag:
         """
-        for lambda_function in self._lambda_functions:
-            lambda_function.create_alias(tag, from_tag)
-            if self.name == 'plans' and 'data-parse' in lambda_function.name:
-                self.update_s3_trigger(tag, lambda_function)
+        map_concurrently(
+            lambda lambda_function: lambda_function.create_alias(tag, from_tag),
+            self._lambda_functions,
+            max_workers=self.max_workers,
+            description=f'Creating lambda aliases {tag}'
+        )
+        self._update_s3_triggers()
 
     def update_lambda_aliases(self, tag, target_tag):
+        map_concurrently(
+            lambda lambda_function: lambda_function.update_alias(tag, target_tag),
+            self._lambda_functions,
+            max_workers=self.max_workers,
+            description=f'Updating lambda aliases {tag}'
+        )
+        self._update_s3_triggers()
+
+    def _update_s3_triggers(self):
+        # Bucket notification configurations are read-modify-written, so these are kept serial
         for lambda_function in self._lambda_functions:
-            lambda_function.update_alias(tag, target_tag)
             if self.name == 'plans' and 'data-parse' in lambda_function.name:
-                self.update_s3_trigger(tag, lambda_function)
+                self.update_s3_trigger(lambda_function)
 
-    def create_apigateway_stages(self, tag):
+    def create_apigateway_stages(self, *tags):
         for apigateway in self._api_gateways:
-            apigateway.create_stage(tag)
+            apigateway.create_stages(tags)
+
+    def get_policy_headroom_report(self):
+        """
+        :return: list[(str, str, int, int)] The function, qualifier, resource policy size and size limit of each alias
+                 whose permissions have been examined
+        """
+        return [(lambda_function.name, *row) for lambda_function in self._lambda_functions for row in lambda_function.get_policy_headroom_report()]
 
     def _get_lambda_function(self, name):
         name = name.format(ENVIRONMENT=self.environment.name)
@@ -65,7 +100,7 @@ class Service(object):
                 return lambda_function
         raise Exception(f'Could not find lambda function {name}')
 
-    def update_s3_trigger(self, semantic_version, lambda_function):
+    def update_s3_trigger(self, lambda_function):
         for s3 in self._s3s:
             if s3._bucket_type == 'performance_data':
-                s3.add_lambda_trigger(semantic_version, lambda_function)
+                s3.reconcile_lambda_triggers(lambda_function)
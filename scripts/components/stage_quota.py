@@ -0,0 +1,77 @@
+from colorama import Fore
+from semver import VersionInfo
+import threading
+
+from components.concurrency import map_concurrently
+from components.exceptions import ApplicationException
+from components.ui import cprint
+
+
+class StageQuotaManager:
+    """
+    Keeps the number of stages on an API Gateway within the per-API limit by pruning old patch-level stages.  The
+    sliding `N_` and `N_M` stages, and the most recent patch-level stages, are always kept.
+    """
+    def __init__(self, api_gateway, stage_limit=10, keep_patches=3):
+        """
+        :param components.api_gateway.ApiGateway api_gateway:
+        :param int stage_limit: The maximum number of stages the API can have
+        :param int keep_patches: The number of most recent patch-level stages never to prune
+        """
+        self._api_gateway = api_gateway
+        self.stage_limit = stage_limit
+        self.keep_patches = keep_patches
+        self._lock = threading.Lock()
+
+    def get_stages(self):
+        """
+        :return: dict[str, str|None] Every stage's name, all of which count towards the limit, mapped to its
+                 `LambdaAlias` stage variable
+        """
+        return self._api_gateway.get_stages()
+
+    def get_prunable_stages(self, stage_names, protected=()):
+        """
+        Choose which stages may be pruned, oldest first
+        :param iterable[str] stage_names: The existing stages
+        :param iterable[str] protected: Stage names which must not be pruned
+        :return: list[str]
+        """
+        patches = []
+        for stage_name in stage_names:
+            if stage_name in protected:
+                continue
+            try:
+                patches.append((VersionInfo.parse(stage_name.replace('_', '.')), stage_name))
+            except ValueError:
+                # Sliding `N_`/`N_M` stages, or not a versioned stage at all
+                continue
+        patches.sort()
+        if self.keep_patches > 0:
+            patches = patches[:-self.keep_patches]
+        return [stage_name for _, stage_name in patches]
+
+    def make_room(self, new_stage_names):
+        """
+        Prune enough stages that the given stages can be created
+        :param list[str] new_stage_names:
+        """
+        with self._lock:
+            stages = self.get_stages()
+            required = len(stages) + len([s for s in new_stage_names if s not in stages]) - self.stage_limit
+            if required <= 0:
+                return
+
+            # Only stages serving a Lambda alias are pruned, along with their alias
+            prunable = self.get_prunable_stages([s for s, alias in stages.items() if alias is not None], protected=new_stage_names)
+            if len(prunable) < required:
+                raise ApplicationException(f'API {self._api_gateway.id} needs {required} more stages, but only {len(prunable)} can be pruned.  Delete some old stages using delete_apigateway_stage.py')
+
+            to_prune = prunable[:required]
+            cprint(f'Pruning API Gateway stages {", ".join(to_prune)} from {self._api_gateway.name} to stay within the limit of {self.stage_limit}', colour=Fore.YELLOW)
+            map_concurrently(self._prune, to_prune, description=f'Pruning API Gateway stages for {self._api_gateway.name}')
+
+    def _prune(self, stage_name):
+        # Stage and alias names are both the semantic version with dots replaced, so the stage name round-trips
+        self._api_gateway.delete_stage(stage_name)
+        self._api_gateway.lambda_function.delete_alias(stage_name)
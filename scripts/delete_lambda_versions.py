@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+# Delete published Lambda versions which are no longer referenced by any alias or API Gateway stage
+
+import argparse
+import boto3
+from colorama import Fore
+
+from components.ui import cprint, confirm
+from components.api_gateway import ApiGateway
+from components.concurrency import map_concurrently
+from components.exceptions import ApplicationException
+from components.lambda_function import LambdaFunction
+
+
+def main():
+    lambda_function = LambdaFunction(
+        region_name=args.region,
+        environment_name=args.environment,
+        service_name=args.service,
+        function_name=f'{args.service}-{args.environment}-apigateway-execute',
+        s3_filepath='apigateway.zip'
+    )
+    api_gateway = ApiGateway(f'{args.service}-{args.environment}-apigateway', lambda_function)
+    stage_aliases = api_gateway.get_stage_lambda_aliases()
+
+    lambda_functions = [lambda_function] + [LambdaFunction(
+        region_name=args.region,
+        environment_name=args.environment,
+        service_name=args.service,
+        function_name=function_name,
+        s3_filepath=None
+    ) for function_name in args.function_names]
+
+    garbage = []
+    for function in lambda_functions:
+        referenced = stage_aliases.values() if function is lambda_function else ()
+        versions = function.get_unreferenced_versions(referenced, keep_last=args.keep_last)
+        reclaimed = sum(v.get('CodeSize', 0) for v in versions)
+        cprint(f'{function.name}: {len(versions)} of {len(function.inventory.versions)} versions unreferenced, {format_bytes(reclaimed)} reclaimable', colour=Fore.CYAN)
+        for v in versions:
+            cprint(f"    {v['Version']}  {v.get('LastModified', '')}  {format_bytes(v.get('CodeSize', 0))}")
+        garbage += [(function, v) for v in versions]
+
+    total = sum(v.get('CodeSize', 0) for _, v in garbage)
+    cprint(f'{len(garbage)} versions to delete, reclaiming {format_bytes(total)}', colour=Fore.YELLOW)
+
+    if args.dry_run or len(garbage) == 0:
+        return
+
+    if not args.yes and not confirm('Delete these versions? '):
+        exit(0)
+
+    map_concurrently(
+        lambda item: item[0].delete_version(item[1]['Version']),
+        garbage,
+        max_workers=args.max_workers,
+        description='Deleting lambda versions'
+    )
+    cprint(f'Deleted {len(garbage)} versions', colour=Fore.GREEN)
+
+
+def format_bytes(size):
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete Lambda versions which are not referenced by any alias or API Gateway stage')
+    parser.add_argument('--region',
+                        choices=['us-west-2'],
+                        default='us-west-2',
+                        help='AWS Region')
+    parser.add_argument('environment',
+                        choices=['dev', 'test', 'production'],
+                        help='Environment')
+    parser.add_argument('service',
+                        choices=[
+                            'hardware',
+                            'meta',
+                            'plans',
+                            'preprocessing',
+                            'statsapi',
+                            'time',
+                            'users',
+                        ],
+                        help='The service being affected')
+
+    parser.add_argument('--function',
+                        dest='function_names',
+                        action='append',
+                        default=[],
+                        help='Additional Lambda functions to clean up, besides the API Gateway function')
+    parser.add_argument('--keep-last',
+                        dest='keep_last',
+                        type=int,
+                        default=10,
+                        help='The number of most recent versions to keep even if unreferenced')
+    parser.add_argument('--max-workers',
+                        dest='max_workers',
+                        type=int,
+                        default=8,
+                        help='The maximum number of concurrent deletions')
+    parser.add_argument('--dry-run',
+                        dest='dry_run',
+                        action='store_true',
+                        help='Only report what would be deleted')
+
+    parser.add_argument('--profile-name',
+                        dest='profile_name',
+                        default='default',
+                        help='boto3 profile to use')
+    parser.add_argument('-y',
+                        dest='yes',
+                        action='store_true',
+                        help='Skip confirmations')
+
+    args = parser.parse_args()
+
+    boto3.setup_default_session(profile_name=args.profile_name, region_name=args.region)
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        cprint('Exiting', colour=Fore.YELLOW)
+        exit(1)
+    except ApplicationException as ex:
+        cprint(str(ex), colour=Fore.RED)
+        exit(1)
+    except Exception as ex:
+        cprint(str(ex), colour=Fore.RED)
+        raise ex
+    else:
+        exit(0)
@@ -9,6 +9,7 @@ import subprocess
 
 from components.environment import Environment, LegacyEnvironment
 from components.exceptions import ApplicationException
+from components.repository import await_build_completions, compare_remote_statuses
 from components.ui import confirm, cprint
 
 
@@ -44,34 +45,28 @@ def map_config(old_config):
     return new_config
 
 
-def validate_semver_tag(new_tag, old_tags):
+def validate_semver_tag(new_tag, semver_index):
     """
     Check for various version consistency gotchas
     :param VersionInfo new_tag:
-    :param list[VersionInfo] old_tags:
+    :param SemverIndex semver_index:
     :return:
     """
-    for old_tag in old_tags:
-        if old_tag == new_tag:
-            raise ApplicationException(f'Release {args.service}:{new_tag} already exists. To roll back to a previous version, run [deploy.py {args.environment} {args.service} --ref {new_tag}]')
-        elif old_tag > new_tag:
-            if old_tag.major != new_tag.major:
-                # It's ok to prepare a legacy release
-                pass
-            elif old_tag.minor != new_tag.minor:
-                # It's ok to patch an old minor release when a new minor release exists
-                pass
-            elif args.force:
-                cprint(f"Shouldn't be releasing {args.service}:{new_tag} because a later version {old_tag} already exists.", colour=Fore.RED)
-            else:
-                raise ApplicationException(f'Cannot release {args.service}:{new_tag} because a later version {old_tag} already exists.')
+    if new_tag in semver_index:
+        raise ApplicationException(f'Release {args.service}:{new_tag} already exists. To roll back to a previous version, run [deploy.py {args.environment} {args.service} --ref {new_tag}]')
+
+    # It's ok to prepare a legacy release, or to patch an old minor release when a new minor release exists
+    later_tag = semver_index.later_in_minor(new_tag)
+    if later_tag is not None:
+        if args.force:
+            cprint(f"Shouldn't be releasing {args.service}:{new_tag} because a later version {later_tag} already exists.", colour=Fore.RED)
+        else:
+            raise ApplicationException(f'Cannot release {args.service}:{new_tag} because a later version {later_tag} already exists.')
 
     # Prevent skipping versions
     previous_tag = get_previous_semver(new_tag)
-    for old_tag in old_tags:
-        if old_tag >= previous_tag:
-            break
-    else:
+    latest_tag = semver_index.latest()
+    if latest_tag is None or latest_tag < previous_tag:
         if args.force:
             cprint(f"Shouldn't be releasing {args.service}:{new_tag} because it skips (at least) version {previous_tag}.", colour=Fore.RED)
         else:
@@ -122,8 +117,8 @@ def main():
         service_repository = environment.get_service_repository(args.service)
         if args.environment_version != '':
             environment_version = environment.repository.parse_ref(args.environment_version)[0]
-            # Check that the build we're about to deploy has actually been completed
-            environment.repository.await_build_completion(environment_version)
+            # Check that the build we're about to deploy has actually been completed, before anything is tagged
+            await_build_completions([(environment.repository, environment_version)], timeout=args.build_timeout)
         else:
             environment_version = None
 
@@ -149,7 +144,6 @@ def main():
             raise ApplicationException('Deployments to environments above dev must be tagged')
     else:
         version = VersionInfo.parse(args.tag)
-        validate_semver_tag(version, service_repository.get_semver_tags())
 
     #             | head                  | commit    | branch                  | tag
     #  -----------+-----------------------+-----------+-------------------------+-----
@@ -167,7 +161,7 @@ def main():
 
     if ref_type == 'branch':
         try:
-            comparison = service_repository.compare_remote_status(args.ref)
+            comparison, = compare_remote_statuses([(service_repository, args.ref)])
             if comparison == -1:
                 if not confirm(f'Branch {args.ref} is behind origin/{args.ref}.  Are you sure you want to deploy an earlier version?'):
                     exit(0)
@@ -176,6 +170,12 @@ def main():
         except subprocess.CalledProcessError as e:
             raise ApplicationException(str(e))
 
+    if version is not None:
+        if ref_type != 'branch':
+            # Branch deploys have already fetched the tags along with the branch
+            service_repository.fetch_tags()
+        validate_semver_tag(version, service_repository.get_semver_index())
+
     if version is not None:
         cprint(f"Going to tag commit {service_version[0:16]} (from {ref_type} {args.ref}) as {version} and deploy to {args.environment}", colour=Fore.YELLOW)
     else:
@@ -194,7 +194,7 @@ def main():
         service_repository.create_semver_tag(version, service_version)
 
     # Check that the build we're about to deploy has actually been completed
-    service_repository.await_build_completion(service_version)
+    await_build_completions([(service_repository, service_version)], timeout=args.build_timeout)
 
     try:
         # Actually update the service
@@ -229,7 +229,8 @@ def main():
         environment.create_apigateway_stages(args.service, version)
 
         # 'slide' the partially-pinned aliases up to the new version
-        environment.update_sliding_lambda_aliases(args.service, version)
+        environment.update_sliding_lambda_aliases(args.service, version, service_repository.get_semver_index())
+        environment.print_policy_headroom_report(args.service)
 
     else:
         # Explicitly deploy lambda functions anyway to make sure the $LATEST version is up to date
@@ -280,6 +281,12 @@ if __name__ == '__main__':
                         default='',
                         help='Parameters to set new values for ("paramname->newvalue,...")')
 
+    parser.add_argument('--build-timeout',
+                        dest='build_timeout',
+                        type=int,
+                        default=900,
+                        help='Maximum number of seconds to wait for CI builds to complete')
+
     parser.add_argument('--profile-name',
                         dest='profile_name',
                         default='default',